@@ -0,0 +1 @@
+"Benchmarks, run them from the repository root with `python -m benchmarks.<name>`"
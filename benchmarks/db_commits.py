@@ -0,0 +1,151 @@
+"""
+Commits and time needed to save the references of a course to the DB.
+
+It compares one commit per record (the way records were saved before
+`Table.upsert_many` and `DataBase.transaction`) with one commit per page of
+records, as `CanvasStream.run` does while the references are requested, and
+the `save` functions inside a course transaction, as `run_async` does.
+
+    python -m benchmarks.db_commits --folders 50 --files 40 --modules 30
+"""
+
+from __future__ import annotations
+
+import argparse
+from pathlib import Path
+import tempfile
+import time
+
+from canvas_stream import save
+from canvas_stream.api.api import MODULES_PAGE_SIZE
+from canvas_stream.db import DataBase, schema
+from canvas_stream.db.schema import File, Folder
+
+UPDATED_AT = "2021-01-01T00:00:00Z"
+
+
+def rest_folders(course_id: int, folders: int, files: int):
+    "Synthetic REST folders of a course"
+    return [
+        {
+            "id": course_id * 10_000 + folder_id,
+            "full_name": f"course files/folder {folder_id}",
+            "files_count": files,
+            "parent_folder_id": None,
+            "updated_at": UPDATED_AT,
+        }
+        for folder_id in range(folders)
+    ]
+
+
+def rest_files(folder_id: int, files: int):
+    "Synthetic REST files of a folder"
+    return [
+        {
+            "id": folder_id * 1_000 + file_id,
+            "filename": f"file {file_id}.pdf",
+            "updated_at": UPDATED_AT,
+            "url": f"https://canvas.test/files/{file_id}/download?verifier=abc",
+        }
+        for file_id in range(files)
+    ]
+
+
+def gql_modules(course_id: int, modules: int, items: int):
+    "Synthetic GraphQL modules of a course"
+    return [
+        {
+            "_id": str(module_id),
+            "name": f"Module {module_id}",
+            "updatedAt": UPDATED_AT,
+            "moduleItems": [
+                {
+                    "updatedAt": UPDATED_AT,
+                    "content": {
+                        "type": "File" if item_id % 2 else "ExternalUrl",
+                        "_id": str(course_id * 100_000 + module_id * 100 + item_id),
+                        "name": f"Item {item_id}",
+                        "updatedAt": UPDATED_AT,
+                        "url": f"https://canvas.test/items/{item_id}",
+                    },
+                }
+                for item_id in range(items)
+            ],
+        }
+        for module_id in range(modules)
+    ]
+
+
+def save_one_by_one(course_id: int, args: argparse.Namespace):
+    "One commit per record"
+    for module in gql_modules(course_id, args.modules, args.items):
+        for item in module["moduleItems"]:
+            save.module_items([item], course_id, module)
+    for folder_info in rest_folders(course_id, args.folders, args.files):
+        folder = save.folder(folder_info, course_id)
+        for file_info in rest_files(folder.id, args.files):
+            save.files([file_info], folder.id, course_id)
+        folder.upsert()
+
+
+def save_per_page(course_id: int, args: argparse.Namespace):
+    "One commit per page of records (see `CanvasStream._references`)"
+    modules = gql_modules(course_id, args.modules, args.items)
+    for start in range(0, len(modules), MODULES_PAGE_SIZE):
+        with File.__db__.transaction():
+            page = modules[start : start + MODULES_PAGE_SIZE]
+            list(save.module_pages([(course_id, page)]))
+    with File.__db__.transaction():
+        folders = [
+            save.folder(folder_info, course_id)
+            for folder_info in rest_folders(course_id, args.folders, args.files)
+        ]
+    for folder in folders:
+        files = rest_files(folder.id, args.files)
+        list(save.iter_files(files, folder.id, course_id))
+        folder.upsert()
+
+
+def save_in_transaction(course_id: int, args: argparse.Namespace):
+    "A single commit for the whole course"
+    with File.__db__.transaction():
+        for module in gql_modules(course_id, args.modules, args.items):
+            save.module_items(module["moduleItems"], course_id, module)
+        for folder_info in rest_folders(course_id, args.folders, args.files):
+            folder = save.folder(folder_info, course_id)
+            save.files(rest_files(folder.id, args.files), folder.id, course_id)
+            folder.upsert()
+
+
+def run(name: str, function, args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as directory:
+        database = DataBase(str(Path(directory, "canvas.db")))
+        database.load_schema(schema)
+        start = time.perf_counter()
+        for course_id in range(1, args.courses + 1):
+            function(course_id, args)
+        elapsed = time.perf_counter() - start
+        records = sum(1 for _ in File.find()) + sum(1 for _ in Folder.find())
+        database.connection.close()
+    print(
+        f"{name:>12}: {database.commits:6} commits"
+        f" ({database.commits / args.courses:.0f} per course),"
+        f" {elapsed:7.3f}s, {records} files and folders"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--courses", type=int, default=5)
+    parser.add_argument("--folders", type=int, default=20)
+    parser.add_argument("--files", type=int, default=30)
+    parser.add_argument("--modules", type=int, default=10)
+    parser.add_argument("--items", type=int, default=20)
+    args = parser.parse_args()
+    run("before", save_one_by_one, args)
+    run("pages", save_per_page, args)
+    run("transaction", save_in_transaction, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Throughput and CPU time of the downloads, from a local fake Canvas server.
+
+It compares reading 4 KiB chunks with `iter_content` and printing the
+progress of each chunk (the way files were downloaded before) with
+`dowload_to_file`, that reads into a reused buffer and throttles the progress,
+and with `segmented_dowload` (several range requests at the same time).
+The server runs in another process, so the CPU time is only the client's.
+
+    python -m benchmarks.download_throughput --files 4 --size 67108864 --segments 4
+"""
+
+from __future__ import annotations
+
+import argparse
+from contextlib import redirect_stdout
+import io
+import multiprocessing
+from pathlib import Path
+import tempfile
+import time
+
+from canvas_stream.api import CanvasAPI
+from canvas_stream.download import DEFAULT_SEGMENTS
+from canvas_stream.provider import dowload_to_file, segmented_dowload
+
+from .fake_canvas import FakeCanvas, Tenant
+
+
+def serve(tenant: Tenant, ports: multiprocessing.Queue):
+    server = FakeCanvas(tenant)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def dowload_4k_chunks(request_stream, path: Path):
+    "Downloads with 4 KiB chunks, printing the progress of each one"
+    total_bytes = int(request_stream.headers["content-length"])
+    progress = 0
+    with path.open("wb") as file:
+        for data in request_stream.iter_content(chunk_size=4096):
+            file.write(data)
+            progress += len(data)
+            print(f"{progress / total_bytes:4.0%} -- {path}", end="\r")
+        print(end="\n")
+
+
+def run(name: str, function, urls: list[str], directory: str):
+    downloaded = 0
+    # The progress is written to memory, a terminal would be slower
+    with redirect_stdout(io.StringIO()):
+        start, cpu_start = time.perf_counter(), time.process_time()
+        for index, url in enumerate(urls):
+            path = Path(directory, f"{name}-{index}")
+            function(url, path)
+            downloaded += path.stat().st_size
+        elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    print(
+        f"{name:>12}: {downloaded / elapsed / 2**20:8.1f} MiB/s,"
+        f" {cpu:6.3f}s CPU ({cpu / (downloaded / 2**30):.2f}s per GiB)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--size", type=int, default=64 * 2**20, help="bytes per file")
+    parser.add_argument("--segments", type=int, default=DEFAULT_SEGMENTS)
+    args = parser.parse_args()
+
+    tenant = Tenant(courses=1, folders=1, files=args.files, size=args.size)
+    ports: multiprocessing.Queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(tenant, ports), daemon=True)
+    server.start()
+    url = f"http://127.0.0.1:{ports.get()}"
+    api = CanvasAPI(url, "fake", pool_size=args.segments)
+    folder_id = next(iter(tenant.folder_ids(1)))
+    urls = [f"{url}/files/{i}/download" for i in tenant.file_ids(folder_id)]
+    with tempfile.TemporaryDirectory() as directory:
+        # The first requests warm up the server (the content is generated)
+        before = lambda url, path: dowload_4k_chunks(api.download(url), path)
+        run("warm up", before, urls, directory)
+        run("before", before, urls, directory)
+        after = lambda url, path: dowload_to_file(api.download(url), path)
+        run("after", after, urls, directory)
+        segmented = lambda url, path: segmented_dowload(
+            api.download, url, path, args.size, segments=args.segments
+        )
+        run("segmented", segmented, urls, directory)
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
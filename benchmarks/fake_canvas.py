@@ -0,0 +1,427 @@
+"""
+Local fake Canvas server, with a synthetic tenant of a configurable size.
+
+It serves the REST endpoints (with `Link` pagination), the GraphQL queries
+(`allCourses` and the aliased modules query), file downloads (with `Range`
+requests) and `ETag` validators, like Canvas does.
+
+    python -m benchmarks.fake_canvas --courses 5 --folders 10 --files 20
+"""
+
+from __future__ import annotations
+
+import argparse
+from dataclasses import dataclass, field
+import datetime
+from functools import lru_cache
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import sys
+import threading
+import time
+from typing import Any
+from urllib.parse import parse_qs, urlsplit
+
+UPDATED_AT = datetime.datetime(2021, 1, 1)
+# Bytes of a download sent at once when the downloads are slowed down
+SLOW_PIECE_SIZE = 256 * 1024
+
+
+def canvas_datetime(version: int) -> str:
+    "Canvas formatted datetime of a version (seconds since `UPDATED_AT`)"
+    return (UPDATED_AT + datetime.timedelta(seconds=version)).isoformat() + "Z"
+
+
+@lru_cache(maxsize=16)
+def file_content(seed: str, size: int) -> bytes:
+    "Synthetic content of `size` bytes"
+    block = hashlib.sha256(seed.encode()).digest() * 32
+    return (block * (size // len(block) + 1))[:size]
+
+
+def new_version(previous: int = 0) -> int:
+    "Version of an object updated now"
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return max(previous + 1, int((now - UPDATED_AT).total_seconds()) + 1)
+
+
+@dataclass
+class Tenant:
+    """
+    Synthetic Canvas data: `courses` courses, each one with `folders` folders
+    of `files` files of `size` bytes and `modules` modules with `items` items
+    (half files, half external urls).
+    """
+
+    courses: int = 5
+    folders: int = 10
+    files: int = 20
+    size: int = 64 * 1024
+    modules: int = 5
+    items: int = 10
+    # Version of each updated file and course, by id (see `canvas_datetime`)
+    file_versions: dict[int, int] = field(default_factory=dict)
+    course_versions: dict[int, int] = field(default_factory=dict)
+
+    def course_ids(self) -> range:
+        return range(1, self.courses + 1)
+
+    def folder_ids(self, course_id: int) -> range:
+        return range(course_id * 1_000, course_id * 1_000 + self.folders)
+
+    def file_ids(self, folder_id: int) -> range:
+        return range(folder_id * 1_000, folder_id * 1_000 + self.files)
+
+    def update_files(self, course_id: int, count: int):
+        "Updates the first `count` files of a course (and the course)"
+        updated = 0
+        for folder_id in self.folder_ids(course_id):
+            for file_id in self.file_ids(folder_id):
+                if updated == count:
+                    break
+                self.file_versions[file_id] = new_version(
+                    self.file_versions.get(file_id, 0)
+                )
+                updated += 1
+        self.course_versions[course_id] = new_version(
+            self.course_versions.get(course_id, 0)
+        )
+
+    def favorite_courses(self) -> list[dict[str, Any]]:
+        return [
+            {
+                "id": course_id,
+                "name": f"Course {course_id}",
+                "course_code": f"C{course_id}",
+            }
+            for course_id in self.course_ids()
+        ]
+
+    def all_courses(self) -> list[dict[str, Any]]:
+        return [
+            {
+                "_id": str(course_id),
+                "updatedAt": canvas_datetime(self.course_versions.get(course_id, 0)),
+                "name": f"Course {course_id}",
+                "courseCode": f"C{course_id}",
+                "state": "available",
+                "term": {"name": "Term"},
+            }
+            for course_id in self.course_ids()
+        ]
+
+    def course_folders(self, course_id: int) -> list[dict[str, Any]]:
+        return [
+            {
+                "id": folder_id,
+                "full_name": f"course files/folder {folder_id}",
+                "files_count": self.files,
+                "parent_folder_id": None,
+                "updated_at": canvas_datetime(
+                    max(self.file_versions.get(i, 0) for i in self.file_ids(folder_id))
+                ),
+            }
+            for folder_id in self.folder_ids(course_id)
+        ]
+
+    def file(self, base_url: str, file_id: int) -> dict[str, Any]:
+        return {
+            "id": file_id,
+            "folder_id": file_id // 1_000,
+            "filename": f"file {file_id}.pdf",
+            "content-type": "application/pdf",
+            "size": self.size,
+            "updated_at": canvas_datetime(self.file_versions.get(file_id, 0)),
+            "url": f"{base_url}/files/{file_id}/download?verifier=fake",
+        }
+
+    def folder_files(self, base_url: str, folder_id: int) -> list[dict[str, Any]]:
+        return [self.file(base_url, file_id) for file_id in self.file_ids(folder_id)]
+
+    def course_files(self, base_url: str, course_id: int) -> list[dict[str, Any]]:
+        "Files of a course, the most recently updated first"
+        files = [
+            self.file(base_url, file_id)
+            for folder_id in self.folder_ids(course_id)
+            for file_id in self.file_ids(folder_id)
+        ]
+        return sorted(files, key=lambda file: file["updated_at"], reverse=True)
+
+    def course_modules(self, base_url: str, course_id: int) -> list[dict[str, Any]]:
+        modules = []
+        for module_id in range(self.modules):
+            items = []
+            for item_id in range(self.items):
+                content_id = course_id * 100_000 + module_id * 100 + item_id
+                is_file = item_id % 2 == 0
+                items.append(
+                    {
+                        "_id": str(content_id),
+                        "updatedAt": canvas_datetime(0),
+                        "content": {
+                            "type": "File" if is_file else "ExternalUrl",
+                            "_id": str(content_id),
+                            "updatedAt": canvas_datetime(0),
+                            "name": f"Item {item_id}{'.pdf' if is_file else ''}",
+                            "url": (
+                                f"{base_url}/files/{content_id}/download"
+                                if is_file
+                                else f"https://example.com/{content_id}"
+                            ),
+                            **({"contentType": "application/pdf"} if is_file else {}),
+                        },
+                    }
+                )
+            modules.append(
+                {
+                    "_id": str(module_id),
+                    "updatedAt": canvas_datetime(0),
+                    "name": f"Module {module_id}",
+                    "moduleItems": items,
+                }
+            )
+        return modules
+
+    def content(self, file_id: int) -> bytes:
+        "Content of a file, different for each version"
+        return file_content(
+            f"{file_id}:{self.file_versions.get(file_id, 0)}", self.size
+        )
+
+
+class FakeCanvasHandler(BaseHTTPRequestHandler):
+    "Handler of the requests to a `FakeCanvas`"
+
+    protocol_version = "HTTP/1.1"
+    server: FakeCanvas
+
+    def log_message(self, *_):
+        pass
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.headers['Host']}"
+
+    def send_body(
+        self, status: int, body: bytes, headers: dict[str, str], throttled=True
+    ):
+        "Sends a response, with the throttling headers of the Canvas API"
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        if throttled:
+            self.send_header("X-Rate-Limit-Remaining", "700.0")
+            self.send_header("X-Request-Cost", "0.01")
+        self.end_headers()
+        if not throttled and self.server.download_delay:
+            # A slow connection to the file CDN
+            return self.send_slowly(body)
+        self.wfile.write(body)
+
+    def send_slowly(self, body: bytes):
+        "Sends a body in pieces, waiting `download_delay` seconds before each one"
+        for start in range(0, len(body), SLOW_PIECE_SIZE):
+            time.sleep(self.server.download_delay)
+            self.wfile.write(body[start : start + SLOW_PIECE_SIZE])
+
+    def send_json(self, data: Any, links: str = ""):
+        body = json.dumps(data).encode()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.server.count("not_modified")
+            return self.send_body(304, b"", {"ETag": etag})
+        headers = {"Content-Type": "application/json", "ETag": etag}
+        if links:
+            headers["Link"] = links
+        self.send_body(200, body, headers)
+
+    def send_page(self, items: list, path: str, query: dict[str, list[str]]):
+        "Sends a page of `items` with the pagination links"
+        per_page = int(query.get("per_page", ["10"])[0])
+        page = int(query.get("page", ["1"])[0])
+        last_page = max(1, -(-len(items) // per_page))
+        params = "&".join(
+            f"{name}={values[0]}" for name, values in query.items() if name != "page"
+        )
+        url = f"{self.base_url}{path}?{params}"
+        links = [
+            f'<{url}&page=1>; rel="first"',
+            f'<{url}&page={last_page}>; rel="last"',
+        ]
+        if page < last_page:
+            links.append(f'<{url}&page={page + 1}>; rel="next"')
+        self.send_json(items[(page - 1) * per_page : page * per_page], ", ".join(links))
+
+    def send_download(self, file_id: int):
+        self.server.download_started()
+        try:
+            self._send_download(file_id)
+        finally:
+            self.server.download_finished()
+
+    def _send_download(self, file_id: int):
+        content = self.server.tenant.content(file_id)
+        headers = {
+            "Accept-Ranges": "bytes",
+            "ETag": f'"{hashlib.md5(content).hexdigest()}"',
+        }
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        # Like the file CDN of Canvas, without throttling headers
+        if not match or (if_range and if_range != headers["ETag"]):
+            return self.send_body(200, content, headers, throttled=False)
+        start = int(match[1])
+        if start >= len(content):
+            headers = {"Content-Range": f"bytes */{len(content)}"}
+            return self.send_body(416, b"", headers, throttled=False)
+        end = int(match[2]) if match[2] else len(content) - 1
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(content)}"
+        self.send_body(206, content[start : end + 1], headers, throttled=False)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        url = urlsplit(self.path)
+        path, query = url.path, parse_qs(url.query)
+        tenant = self.server.tenant
+        if match := re.fullmatch(r"/files/(\d+)/download", path):
+            self.server.count("download")
+            return self.send_download(int(match[1]))
+
+        self.server.count("rest")
+        if path == "/api/v1/users/self/favorites/courses":
+            return self.send_page(tenant.favorite_courses(), path, query)
+        if match := re.fullmatch(r"/api/v1/courses/(\d+)/folders", path):
+            return self.send_page(tenant.course_folders(int(match[1])), path, query)
+        if match := re.fullmatch(r"/api/v1/courses/(\d+)/files", path):
+            files = tenant.course_files(self.base_url, int(match[1]))
+            return self.send_page(files, path, query)
+        if match := re.fullmatch(r"/api/v1/folders/(\d+)/files", path):
+            files = tenant.folder_files(self.base_url, int(match[1]))
+            return self.send_page(files, path, query)
+        if match := re.fullmatch(r"/api/v1/files/(\d+)", path):
+            return self.send_json(tenant.file(self.base_url, int(match[1])))
+        self.send_body(404, b"", {})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self.server.count("graphql")
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        query, variables = request["query"], request.get("variables") or {}
+        tenant = self.server.tenant
+        if "allCourses" in query:
+            return self.send_json({"data": {"allCourses": tenant.all_courses()}})
+
+        data = {}
+        first = variables.get("first") or 10
+        for alias, course_variable in re.findall(
+            r"(\w+): course\(id: \$(\w+)\)", query
+        ):
+            course_id = int(variables[course_variable])
+            after = variables.get(course_variable.replace("course", "after"))
+            start = int(after) if after else 0
+            modules = tenant.course_modules(self.base_url, course_id)
+            data[alias] = {
+                "modulesConnection": {
+                    "pageInfo": {
+                        "hasNextPage": start + first < len(modules),
+                        "endCursor": str(start + first),
+                    },
+                    "nodes": modules[start : start + first],
+                }
+            }
+        self.send_json({"data": data})
+
+
+class FakeCanvas(ThreadingHTTPServer):
+    "Fake Canvas server of a `Tenant`, listening on a local port"
+
+    daemon_threads = True
+
+    def __init__(self, tenant: Tenant, port: int = 0) -> None:
+        super().__init__(("127.0.0.1", port), FakeCanvasHandler)
+        self.tenant = tenant
+        # Requests by kind (rest, graphql, download and not_modified)
+        self.requests: dict[str, int] = {}
+        # `time.perf_counter()` of the first request of each kind
+        self.first_request_at: dict[str, float] = {}
+        # Seconds waited before sending each piece of a download (0 is not slowed)
+        self.download_delay = 0.0
+        # Downloads being sent, and the most sent at the same time
+        self.downloads_in_flight = 0
+        self.max_downloads_in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def count(self, kind: str):
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            self.first_request_at.setdefault(kind, time.perf_counter())
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests.clear()
+            self.first_request_at.clear()
+            self.max_downloads_in_flight = self.downloads_in_flight
+
+    def download_started(self):
+        with self._lock:
+            self.downloads_in_flight += 1
+            self.max_downloads_in_flight = max(
+                self.max_downloads_in_flight, self.downloads_in_flight
+            )
+
+    def download_finished(self):
+        with self._lock:
+            self.downloads_in_flight -= 1
+
+    def handle_error(self, request, client_address):
+        # The clients close the downloads they don't need (a changed file)
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self) -> FakeCanvas:
+        "Serves the requests in a background thread"
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def tenant_arguments(parser: argparse.ArgumentParser):
+    "Adds the arguments of the size of a `Tenant`"
+    parser.add_argument("--courses", type=int, default=5)
+    parser.add_argument("--folders", type=int, default=10)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--size", type=int, default=64 * 1024, help="bytes per file")
+    parser.add_argument("--modules", type=int, default=5)
+    parser.add_argument("--items", type=int, default=10)
+
+
+def tenant_from(args: argparse.Namespace) -> Tenant:
+    return Tenant(
+        courses=args.courses,
+        folders=args.folders,
+        files=args.files,
+        size=args.size,
+        modules=args.modules,
+        items=args.items,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    tenant_arguments(parser)
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    server = FakeCanvas(tenant_from(args), args.port)
+    print(f"Serving a fake Canvas at {server.url}, stop it with Ctrl+C")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Wall time, requests, DB commits and peak memory of a sync with a fake Canvas.
+
+Three iterations are measured: the first sync (every file is downloaded),
+an iteration without changes and an iteration after some files of a course
+were updated. The time to the first download and the peak memory (RSS, the
+peak of the process so far) are shown too.
+
+    python -m benchmarks.sync --courses 10 --folders 20 --files 30 --size 16384
+"""
+
+from __future__ import annotations
+
+import argparse
+from contextlib import redirect_stdout
+import io
+from pathlib import Path
+import resource
+import sys
+import tempfile
+import time
+
+from canvas_stream import CanvasStream
+
+from .fake_canvas import FakeCanvas, tenant_arguments, tenant_from
+
+
+def peak_rss_mib() -> float:
+    "Peak resident memory of the process"
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB in Linux, bytes in macOS
+    return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def run_iteration(
+    name: str, server: FakeCanvas, canvas_stream: CanvasStream, args: argparse.Namespace
+):
+    server.reset_counts()
+    commits = canvas_stream.database.commits
+    output = sys.stdout if args.verbose else io.StringIO()
+    start = time.perf_counter()
+    with redirect_stdout(output):
+        if args.asyncio:
+            canvas_stream.run_async(iterate=False)
+        else:
+            canvas_stream.run(iterate=False)
+    elapsed = time.perf_counter() - start
+    requests = server.requests
+    first_download = server.first_request_at.get("download")
+    first_download = f"{first_download - start:.3f}s" if first_download else "-"
+    print(
+        f"{name:>12}: {elapsed:7.3f}s,"
+        f" {sum(requests.values()) - requests.get('not_modified', 0):5} requests"
+        f" ({requests.get('rest', 0)} REST, {requests.get('graphql', 0)} GraphQL,"
+        f" {requests.get('download', 0)} downloads,"
+        f" {requests.get('not_modified', 0)} not modified),"
+        f" {canvas_stream.database.commits - commits:4} commits,"
+        f" first download {first_download},"
+        f" {peak_rss_mib():6.1f} MiB peak RSS"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    tenant_arguments(parser)
+    parser.add_argument(
+        "--updated", type=int, default=10, help="files updated between iterations"
+    )
+    parser.add_argument("--asyncio", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="show the output")
+    args = parser.parse_args()
+
+    tenant = tenant_from(args)
+    server = FakeCanvas(tenant).start()
+    with tempfile.TemporaryDirectory() as directory:
+        canvas_stream = CanvasStream(
+            config={
+                "url": server.url,
+                "access_token": "fake",
+                "db_name": str(Path(directory, "canvas.db")),
+                "response_cache": str(Path(directory, "canvas.cache.db")),
+                "output_path": str(Path(directory, "output")),
+            }
+        )
+        run_iteration("first sync", server, canvas_stream, args)
+        run_iteration("no changes", server, canvas_stream, args)
+        tenant.update_files(course_id=1, count=args.updated)
+        run_iteration("incremental", server, canvas_stream, args)
+        canvas_stream.database.connection.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,49 @@
 "Canvas Stream"
 
-from .main import CanvasStream, main
-from .api import CanvasAPI
-from .provider import CanvasStreamProvider
+import sys
+import types
+
+# The public objects are imported when they are used (PEP 562), so the
+# commands that only read the database don't import `requests`
+_LAZY_IMPORTS = {
+    "CanvasStream": ".main",
+    "AsyncCanvasAPI": ".api",
+    "CanvasAPI": ".api",
+    "CanvasStreamProvider": ".provider",
+}
+
+__all__ = [*_LAZY_IMPORTS, "main"]
+
+
+def main(pause_time=60, iterate=True, config=None):
+    "Runs the program, see `canvas_stream.main.main`"
+    # pylint: disable=import-outside-toplevel
+    from .main import main as run_main
+
+    return run_main(pause_time, iterate, config)
+
+
+def __getattr__(name: str):
+    if name not in _LAZY_IMPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from importlib import import_module
+
+    value = getattr(import_module(_LAZY_IMPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted([*globals(), *__all__])
+
+
+class _Package(types.ModuleType):
+    "The package, its `main` stays the function when the `main` submodule is imported"
+
+    def __setattr__(self, name, value):
+        if name == "main" and isinstance(value, types.ModuleType):
+            return
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _Package
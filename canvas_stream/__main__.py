@@ -3,6 +3,6 @@
 import sys
 
 if __name__ == "__main__":
-    from . import main
+    from .cli import cli
 
-    sys.exit(main())
+    sys.exit(cli())
@@ -1,3 +1,4 @@
 "Module that handles requests"
 
 from .api import CanvasAPI
+from .async_api import AsyncCanvasAPI
@@ -2,41 +2,154 @@
 
 from __future__ import annotations
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice, takewhile
 from urllib.parse import urlsplit, urlunsplit
 from pathlib import Path
+from typing import Any, Iterable, Iterator
 import http.client
+import json
+import time
 
 import requests
+import requests.adapters
 
-from .helpers import gql_query
+from ..helpers import naive_datetime
+from ..metrics import METRICS
+from .cache import ResponseCache
+from .helpers import gql_modules_query, gql_query, page_number, with_query
+from .throttle import (
+    RateLimiter,
+    RetryPolicy,
+    is_throttled,
+    should_retry,
+    throttling_headers,
+)
 from .types import GraphQLCourse, GraphQLModule, RestCourse, RestFile, RestFolder
 
 REQUEST_SCHEME = "https"
 REST_ENDPOINT = "/api/v1"
 GQL_ENDPOINT = "/api/graphql"
 GQL_ALL_COURSES = gql_query("courses")
-GQL_MODULES_AND_ITEMS = gql_query("modules_items")
+REST_PER_PAGE = 100
+PREFETCHED_PAGES = 4
+# Modules requested for each course in a GQL query
+MODULES_PAGE_SIZE = 10
+# Courses requested in a single GQL query
+MODULES_BATCH_SIZE = 10
 
 
 class CanvasAPI:
     "A simple interface for the CanvasAPI"
 
-    def __init__(self, url: str, access_token: str) -> None:
+    def __init__(
+        self,
+        url: str,
+        access_token: str,
+        *,
+        pool_size: int = 10,
+        cache: ResponseCache | None = None,
+        limiter: RateLimiter | None = None,
+        retry_policy: RetryPolicy | None = None,
+        adapter: requests.adapters.HTTPAdapter | None = None,
+        page_workers: int = PREFETCHED_PAGES,
+    ) -> None:
+        self.cache = cache
+        # The limiter may be shared with other clients that use the same token
+        self.limiter = limiter or RateLimiter()
+        self.retry_policy = retry_policy or RetryPolicy()
         self._session = requests.session()
+        # Concurrent downloads share the connections of this session, the
+        # `adapter` (its connection pools) may be shared with other clients
+        self._owns_adapter = adapter is None
+        adapter = adapter or requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._scheme = urlsplit(url).scheme or REQUEST_SCHEME
         self._location = urlsplit(url).netloc
+        # Threads requesting the following pages of the paginated queries
+        self._pages_executor = ThreadPoolExecutor(
+            max_workers=max(1, page_workers), thread_name_prefix="canvas-stream-pages"
+        )
         self._session.headers.update({"Authorization": f"Bearer {access_token}"})
 
     def __repr__(self):
         return f"{type(self).__name__}({self._location})"
 
-    def _get(self, url: str, *, stream=False):
+    def close(self):
+        "Stops the threads requesting pages and closes the connections (if not shared)"
+        self._pages_executor.shutdown(wait=False, cancel_futures=True)
+        if self._owns_adapter:
+            self._session.close()
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a request when the rate limiter allows it, retrying throttled
+        requests, server errors and connection errors with backoff
+        """
+        kind = "graphql" if method == "POST" else "rest"
+        kind = "download" if kwargs.get("stream") else kind
+        attempt = 0
+        while True:
+            reserved = self.limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self._session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.limiter.update({}, reserved)
+                METRICS.inc("requests_total", kind=kind, status="error")
+                if attempt >= self.retry_policy.max_retries:
+                    raise
+                time.sleep(self.retry_policy.delay(attempt))
+                attempt += 1
+                continue
+            finally:
+                elapsed = time.perf_counter() - start
+                METRICS.observe("request_seconds", elapsed, kind=kind)
+
+            METRICS.inc("requests_total", kind=kind, status=response.status_code)
+            self.limiter.update(throttling_headers(response), reserved)
+            if attempt >= self.retry_policy.max_retries or not should_retry(response):
+                return response
+            if is_throttled(response):
+                self.limiter.throttled()
+                METRICS.inc("throttled_requests_total", kind=kind)
+            response.close()
+            time.sleep(self.retry_policy.delay(attempt, response))
+            attempt += 1
+
+    def _cached_request(
+        self,
+        cache: ResponseCache,
+        method: str,
+        url: str,
+        headers: dict[str, str],
+        **kwargs,
+    ) -> requests.Response:
+        "Request that revalidates the response stored in the `cache`"
+        cache_key = ResponseCache.key(method, url, kwargs.get("data"))
+        conditional_headers = {**cache.conditional_headers(cache_key), **headers}
+        response = self._request(method, url, headers=conditional_headers, **kwargs)
+        response = cache.use(cache_key, response)
+        if response.status_code == 304:
+            # The stored response was evicted after the request was sent
+            response = self._request(method, url, headers=headers, **kwargs)
+            response = cache.use(cache_key, response)
+        return response
+
+    def _get(self, url: str, *, stream=False, headers: dict[str, str] | None = None):
         "Makes a GET request to Canvas"
         url_tuple = urlsplit(url)
         if self._location != url_tuple.netloc != "":
             raise ValueError(f"Invalid location for {self}: {url_tuple.netloc}")
 
-        get_url = urlunsplit((REQUEST_SCHEME, self._location, *url_tuple[2:]))
-        response = self._session.get(get_url, stream=stream)
+        get_url = urlunsplit((self._scheme, self._location, *url_tuple[2:]))
+        # Streams (downloads) are not cached
+        if stream or not self.cache:
+            response = self._request("GET", get_url, stream=stream, headers=headers)
+        else:
+            response = self._cached_request(self.cache, "GET", get_url, headers or {})
 
         if response.ok:
             return response
@@ -47,26 +160,80 @@ class CanvasAPI:
         raise requests.RequestException(f"Request `{url}` returned: {code} - {mesage}")
 
     def _rest(self, path: str):
-        "REST query that handles pagination"
-        response = self._get(f"{REST_ENDPOINT}/{path.strip('/')}")
-        new_page = response.links.get("next", None)
-        if not new_page:
-            return response.json()
-
-        # In this case the response is a json list
-        response_data = response.json()
-        while new_page:
-            pagination_response = self._session.get(new_page)
-            response_data.extend(pagination_response.json())
-            new_page = response.links.get("next", None)
-        return response_data
+        "REST query of a single object"
+        return self._get(f"{REST_ENDPOINT}/{path.strip('/')}").json()
+
+    def _rest_pages(self, path: str) -> Iterator[list]:
+        """
+        REST query that handles pagination, yielding page by page.
+
+        Following pages are requested in the background while the current one
+        is used. If the pages are numbered (Canvas sends a `last` link with a
+        page number) up to `PREFETCHED_PAGES` are requested at the same time.
+        """
+        url = with_query(f"{REST_ENDPOINT}/{path.strip('/')}", per_page=REST_PER_PAGE)
+        response = self._get(url)
+        next_link = response.links.get("next", {}).get("url")
+        last_link = response.links.get("last", {}).get("url")
+        yield response.json()
+        if not next_link:
+            return
+
+        next_page, last_page = page_number(next_link), page_number(last_link or "")
+        if next_page and last_page:
+            urls: Iterator[str] = (
+                with_query(next_link, page=page)
+                for page in range(next_page, last_page + 1)
+            )
+            yield from self._fetch_in_order(urls)
+            return
+
+        # The pages are bookmarks, each response has the link to the next one
+        pending = self._pages_executor.submit(self._get, next_link)
+        try:
+            while pending:
+                response = pending.result()
+                next_link = response.links.get("next", {}).get("url")
+                pending = next_link and self._pages_executor.submit(
+                    self._get, next_link
+                )
+                yield response.json()
+        finally:
+            if pending:
+                pending.cancel()
+
+    def _fetch_in_order(self, urls: Iterator[str]) -> Iterator[list]:
+        "Requests up to `PREFETCHED_PAGES` urls at the same time, yields them in order"
+        window: deque[Future[requests.Response]] = deque()
+        try:
+            for url in islice(urls, PREFETCHED_PAGES):
+                window.append(self._pages_executor.submit(self._get, url))
+            while window:
+                response = window.popleft().result()
+                for url in islice(urls, 1):
+                    window.append(self._pages_executor.submit(self._get, url))
+                yield response.json()
+        finally:
+            for future in window:
+                future.cancel()
+
+    def _rest_list(self, path: str) -> Iterator:
+        "Items of a paginated REST query, in constant memory"
+        for page in self._rest_pages(path):
+            yield from page
 
     def _gql(self, query: str, variables: dict = None) -> dict:
         "Makes a POST request to the GraphQL endpoint"
         # GraphQL pagination is complex, it should be handeled in each GQL method
-        url = urlunsplit((REQUEST_SCHEME, self._location, GQL_ENDPOINT, "", ""))
+        url = urlunsplit((self._scheme, self._location, GQL_ENDPOINT, "", ""))
         data = {"query": query, "variables": variables or {}}
-        response = self._session.post(url, json=data).json()
+        body = json.dumps(data, sort_keys=True).encode()
+        headers = {"Content-Type": "application/json"}
+        if self.cache:
+            response = self._cached_request(self.cache, "POST", url, headers, data=body)
+        else:
+            response = self._request("POST", url, data=body, headers=headers)
+        response = response.json()
         if not "errors" in response:
             return response["data"]
 
@@ -74,43 +241,132 @@ class CanvasAPI:
         errors = ", ".join(map(lambda e: e["message"], response["errors"]))
         raise requests.RequestException(f"GQL error: {errors}")
 
-    def download(self, url: str):
-        "Returns a response stream from a `url` that may be used to dowload a file"
-        return self._get(url, stream=True)
+    def download(self, url: str, *, headers: dict[str, str] | None = None):
+        """
+        Returns a response stream from a `url` that may be used to dowload a file.
+        Extra `headers` may be used to make a range request.
+        """
+        return self._get(url, stream=True, headers=headers)
 
+    @METRICS.measured("api_seconds", method="all_courses")
     def all_courses(self) -> list[GraphQLCourse]:
         "All courses available for the user"
         # This seems to have no pagination
         return self._gql(GQL_ALL_COURSES)["allCourses"]
 
-    def favorite_courses(self) -> list[RestCourse]:
+    @METRICS.measured("api_seconds", method="favorite_courses")
+    def favorite_courses(self) -> Iterator[RestCourse]:
         "Favorite courses (courses displayed in the dashboard)"
-        return self._rest("/users/self/favorites/courses")
-
-    def _gql_module(self, course_id: int, after: str = None) -> tuple[dict, list]:
-        variables = {"course_id": course_id, "after": after}
-        response = self._gql(GQL_MODULES_AND_ITEMS, variables)
-        response_data = response["course"]["modulesConnection"]
-        return response_data["pageInfo"], response_data["nodes"]
+        return self._rest_list("/users/self/favorites/courses")
 
     def modules_with_items(self, course_id: int) -> list[GraphQLModule]:
         "Modules with items (currently only external links and files)"
-        page_info, all_modules = self._gql_module(course_id)
-        while page_info["hasNextPage"]:
-            page_info, modules = self._gql_module(course_id, page_info["endCursor"])
-            all_modules.extend(modules)
+        return self.modules_with_items_batch([course_id])[course_id]
+
+    @METRICS.measured("api_seconds", method="modules_with_items_batch")
+    def modules_with_items_batch(
+        self,
+        course_ids: Iterable[int],
+        *,
+        page_size: int = MODULES_PAGE_SIZE,
+        batch_size: int = MODULES_BATCH_SIZE,
+    ) -> dict[int, list[GraphQLModule]]:
+        "Modules with items of many courses, by course id (see `iter_modules_pages`)"
+        all_modules: dict[int, list[GraphQLModule]] = {i: [] for i in course_ids}
+        pages = self.iter_modules_pages(
+            list(all_modules), page_size=page_size, batch_size=batch_size
+        )
+        for course_id, modules in pages:
+            all_modules[course_id].extend(modules)
         return all_modules
 
-    def folders(self, course_id: int) -> list[RestFolder]:
-        "Courses folders"
-        return self._rest(f"/courses/{course_id}/folders")
+    @METRICS.measured("api_seconds", method="iter_modules_pages")
+    def iter_modules_pages(
+        self,
+        course_ids: Iterable[int],
+        *,
+        page_size: int = MODULES_PAGE_SIZE,
+        batch_size: int = MODULES_BATCH_SIZE,
+    ) -> Iterator[tuple[int, list[GraphQLModule]]]:
+        """
+        Pages of modules with items of many courses, as `(course_id, modules)`,
+        yielded as each query returns (fetched while iterating).
+        Each query asks for a page of modules of up to `batch_size` courses,
+        the courses with more pages are requested again with their own cursor.
+        """
+        cursors: dict[int, str | None] = dict.fromkeys(course_ids)
+        while cursors:
+            batch = list(islice(cursors.items(), batch_size))
+            variables: dict[str, Any] = {"first": page_size}
+            for index, (course_id, cursor) in enumerate(batch):
+                variables[f"course_{index}"] = course_id
+                variables[f"after_{index}"] = cursor
+            response = self._gql(gql_modules_query(len(batch)), variables)
+
+            for index, (course_id, _) in enumerate(batch):
+                course = response[f"course_{index}"]
+                # The course is null if it's not available for the user
+                connection = course["modulesConnection"] if course else None
+                if not connection:
+                    del cursors[course_id]
+                    continue
+                if connection["pageInfo"]["hasNextPage"]:
+                    cursors[course_id] = connection["pageInfo"]["endCursor"]
+                else:
+                    del cursors[course_id]
+                yield course_id, connection["nodes"]
+
+    @METRICS.measured("api_seconds", method="folders")
+    def folders(self, course_id: int) -> Iterator[RestFolder]:
+        "Courses folders (fetched while iterating)"
+        return self._rest_list(f"/courses/{course_id}/folders")
 
-    def files(self, folder_id: int) -> list[RestFile]:
-        "Files of a folder"
-        return self._rest(f"/folders/{folder_id}/files")
+    @METRICS.measured("api_seconds", method="files")
+    def files(self, folder_id: int) -> Iterator[RestFile]:
+        "Files of a folder (fetched while iterating)"
+        return self._rest_list(f"/folders/{folder_id}/files")
 
+    @METRICS.measured("api_seconds", method="course_files")
+    def course_files(
+        self, course_id: int, updated_since: str | None = None
+    ) -> Iterator[RestFile]:
+        """
+        Files of a course (of every folder), the most recently updated first.
+        With `updated_since` (a naive UTC datetime) the files updated before
+        are not requested, the pagination stops when the first one is found.
+        """
+        files = self._rest_list(
+            f"/courses/{course_id}/files?sort=updated_at&order=desc"
+        )
+        if not updated_since:
+            return files
+        return takewhile(
+            lambda file: naive_datetime(file["updated_at"]) >= updated_since, files
+        )
+
+    @METRICS.measured("api_seconds", method="file")
     def file(self, file_id: int) -> RestFile:
         "Single file"
         # Fore some reason, GraphQL doesn't generates always the download url
         # It that case, a new request should be made to the REST API
         return self._rest(f"/files/{file_id}")
+
+    @METRICS.measured("api_seconds", method="files_by_id")
+    def files_by_id(
+        self, file_ids: Iterable[int], *, workers: int = PREFETCHED_PAGES
+    ) -> dict[int, RestFile]:
+        """
+        Many single files by id, requested concurrently.
+        The files that couldn't be requested are not included.
+        """
+
+        def file_or_none(file_id: int) -> RestFile | None:
+            try:
+                return self.file(file_id)
+            except requests.RequestException:
+                return None
+
+        file_ids = list(file_ids)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            files = executor.map(file_or_none, file_ids)
+            return {file_id: file for file_id, file in zip(file_ids, files) if file}
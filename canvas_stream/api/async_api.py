@@ -0,0 +1,139 @@
+"Asyncio interface for the CanvasAPI"
+
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Iterable, TypeVar
+
+from requests import Response
+
+from .api import MODULES_BATCH_SIZE, MODULES_PAGE_SIZE, CanvasAPI
+from .cache import ResponseCache
+from .throttle import RateLimiter, RetryPolicy
+from .types import GraphQLCourse, GraphQLModule, RestCourse, RestFile, RestFolder
+
+T = TypeVar("T")
+
+DEFAULT_MAX_IN_FLIGHT = 64
+
+
+class AsyncCanvasAPI:
+    """
+    An asyncio interface for the CanvasAPI, with the same methods as `CanvasAPI`.
+
+    The requests are made by a pool of threads that share the pooled
+    connections of a `CanvasAPI`, so this module doesn't need another
+    HTTP dependency. `max_in_flight` is the number of requests that can
+    be waiting for a response at the same time.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        access_token: str,
+        *,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        cache: ResponseCache | None = None,
+        limiter: RateLimiter | None = None,
+        retry_policy: RetryPolicy | None = None,
+    ) -> None:
+        self.sync_api = CanvasAPI(
+            url,
+            access_token,
+            pool_size=max_in_flight,
+            cache=cache,
+            limiter=limiter,
+            retry_policy=retry_policy,
+            # The paginated lists requested at the same time share these threads
+            page_workers=max_in_flight,
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_in_flight, thread_name_prefix="canvas-stream-api"
+        )
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.sync_api._location})"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        self.close()
+
+    def close(self):
+        "Stops the threads used to make the requests and closes the connections"
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.sync_api.close()
+
+    async def _call(self, function: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(function, *args))
+
+    async def _call_list(
+        self, function: Callable[..., Iterable[T]], *args: Any
+    ) -> list[T]:
+        "Consumes the paginated iterator of `function` in a thread"
+        return await self._call(lambda: list(function(*args)))
+
+    async def download(
+        self, url: str, *, headers: dict[str, str] | None = None
+    ) -> Response:
+        "Returns a response stream from a `url` that may be used to dowload a file"
+        return await self._call(partial(self.sync_api.download, headers=headers), url)
+
+    async def all_courses(self) -> list[GraphQLCourse]:
+        "All courses available for the user"
+        return await self._call(self.sync_api.all_courses)
+
+    async def favorite_courses(self) -> list[RestCourse]:
+        "Favorite courses (courses displayed in the dashboard)"
+        return await self._call_list(self.sync_api.favorite_courses)
+
+    async def modules_with_items(self, course_id: int) -> list[GraphQLModule]:
+        "Modules with items (currently only external links and files)"
+        return await self._call(self.sync_api.modules_with_items, course_id)
+
+    async def modules_with_items_batch(
+        self,
+        course_ids: Iterable[int],
+        *,
+        page_size: int = MODULES_PAGE_SIZE,
+        batch_size: int = MODULES_BATCH_SIZE,
+    ) -> dict[int, list[GraphQLModule]]:
+        "Modules with items of many courses, by course id"
+        batch = partial(
+            self.sync_api.modules_with_items_batch,
+            page_size=page_size,
+            batch_size=batch_size,
+        )
+        return await self._call(batch, course_ids)
+
+    async def folders(self, course_id: int) -> list[RestFolder]:
+        "Courses folders"
+        return await self._call_list(self.sync_api.folders, course_id)
+
+    async def files(self, folder_id: int) -> list[RestFile]:
+        "Files of a folder"
+        return await self._call_list(self.sync_api.files, folder_id)
+
+    async def course_files(
+        self, course_id: int, updated_since: str | None = None
+    ) -> list[RestFile]:
+        "Files of a course (of every folder), the most recently updated first"
+        return await self._call_list(
+            self.sync_api.course_files, course_id, updated_since
+        )
+
+    async def file(self, file_id: int) -> RestFile:
+        "Single file"
+        return await self._call(self.sync_api.file, file_id)
+
+    async def files_by_id(
+        self, file_ids: Iterable[int], *, workers: int = DEFAULT_MAX_IN_FLIGHT
+    ) -> dict[int, RestFile]:
+        "Many single files by id, requested concurrently"
+        return await self._call(
+            partial(self.sync_api.files_by_id, workers=workers), file_ids
+        )
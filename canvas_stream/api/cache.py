@@ -0,0 +1,161 @@
+"Persistent cache of Canvas responses, revalidated with conditional requests"
+
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+DEFAULT_MAX_ENTRIES = 5000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Headers kept with the body, needed to use a cached response
+CACHED_HEADERS = ("content-type", "link")
+# Number of stored responses between evictions
+EVICT_EVERY = 50
+
+
+class ResponseCache:
+    """
+    Stores the responses that have a validator (`ETag` or `Last-Modified`)
+    in a sqlite file, so the next request for the same url (or GraphQL body)
+    can be sent with `If-None-Match`/`If-Modified-Since`. If the server
+    answers `304 Not Modified` the stored response is used.
+
+    The least recently used responses are evicted when there are more
+    than `max_entries` or they use more than `max_bytes`.
+    It may be used from many threads.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Counters, `saved_bytes` is the size of the bodies that weren't sent
+        self.hits = 0
+        self.misses = 0
+        self.saved_bytes = 0
+        self._stores = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS response ("
+            " key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT,"
+            " headers TEXT, body BLOB, used_at REAL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS response_used_at ON response (used_at)"
+        )
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.path})"
+
+    @staticmethod
+    def key(method: str, url: str, body: bytes | None = None) -> str:
+        "Cache key of a request, POST requests are identified by the body hash"
+        digest = hashlib.sha256(f"{method} {url}\n".encode())
+        digest.update(body or b"")
+        return digest.hexdigest()
+
+    def conditional_headers(self, key: str) -> dict[str, str]:
+        "Headers to revalidate the stored response of `key` (if there's one)"
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT etag, last_modified FROM response WHERE key = ?", (key,)
+            ).fetchone()
+        if not row:
+            return {}
+        etag, last_modified = row
+        if etag:
+            return {"If-None-Match": etag}
+        return {"If-Modified-Since": last_modified}
+
+    def use(self, key: str, response: requests.Response) -> requests.Response:
+        """
+        Returns the response that should be used: the stored one if `response`
+        is a `304 Not Modified`, or `response` (that is stored if it can be).
+        If the stored response was evicted meanwhile, the `304` is returned,
+        the request must be sent again without the conditional headers.
+        """
+        if response.status_code == 304:
+            cached_response = self._load(key, response)
+            return response if cached_response is None else cached_response
+        if response.ok:
+            self._store(key, response)
+        return response
+
+    def _load(self, key: str, response: requests.Response) -> requests.Response | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT headers, body FROM response WHERE key = ?", (key,)
+            ).fetchone()
+            if not row:
+                return None
+            self.hits += 1
+            self.saved_bytes += len(row[1])
+            self._connection.execute(
+                "UPDATE response SET used_at = ? WHERE key = ?", (time.time(), key)
+            )
+            self._connection.commit()
+        cached_response = requests.Response()
+        cached_response.status_code = 200
+        cached_response.headers = CaseInsensitiveDict(json.loads(row[0]))
+        cached_response._content = row[1]  # pylint: disable=protected-access
+        cached_response.url = response.url
+        cached_response.request = response.request
+        cached_response.encoding = response.encoding or "utf-8"
+        return cached_response
+
+    def _store(self, key: str, response: requests.Response):
+        with self._lock:
+            self.misses += 1
+        etag = response.headers.get("etag")
+        last_modified = response.headers.get("last-modified")
+        if not etag and not last_modified:
+            return
+        headers = {
+            h: response.headers[h] for h in CACHED_HEADERS if h in response.headers
+        }
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    etag,
+                    last_modified,
+                    json.dumps(headers),
+                    response.content,
+                    time.time(),
+                ),
+            )
+            self._stores += 1
+            if self._stores % EVICT_EVERY == 0:
+                self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        "Deletes the least recently used responses over the limits"
+        self._connection.execute(
+            "DELETE FROM response WHERE key IN ("
+            " SELECT key FROM response ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self._connection.execute(
+            "DELETE FROM response WHERE key IN ("
+            " SELECT key FROM (SELECT key, SUM(length(body))"
+            "  OVER (ORDER BY used_at DESC) AS total FROM response)"
+            " WHERE total > ?)",
+            (self.max_bytes,),
+        )
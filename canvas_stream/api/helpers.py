@@ -1,6 +1,11 @@
 "Helpers"
 
+from __future__ import annotations
+
+from functools import lru_cache
 from pathlib import Path
+from typing import Any
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlsplit, urlunsplit
 
 
 def gql_query(file_name: str) -> str:
@@ -8,3 +13,41 @@ def gql_query(file_name: str) -> str:
     path = Path(__file__).parent.joinpath("gql", file_name).with_suffix(".gql")
     with path.open() as file:
         return file.read()
+
+
+def with_query(url: str, **params: Any) -> str:
+    "Adds (or replaces) query parameters of an url"
+    url_tuple = urlsplit(url)
+    query = dict(parse_qsl(url_tuple.query))
+    query.update({key: str(value) for key, value in params.items()})
+    return urlunsplit(url_tuple._replace(query=urlencode(query)))
+
+
+def page_number(url: str) -> int | None:
+    "The `page` parameter of a pagination url, if it's a number"
+    page = parse_qs(urlsplit(url).query).get("page", [""])[0]
+    return int(page) if page.isdigit() else None
+
+
+GQL_MODULE_FIELDS = gql_query("module_fields")
+
+
+@lru_cache(maxsize=None)
+def gql_modules_query(courses_count: int) -> str:
+    """
+    GQL query of a page of modules of many courses, each course has an alias
+    (`course_0`, `course_1`, ...) and the variables `$course_N` and `$after_N`
+    """
+    variables = ", ".join(
+        f"$course_{n}: ID, $after_{n}: String" for n in range(courses_count)
+    )
+    courses = "\n".join(
+        f"  course_{n}: course(id: $course_{n}) {{\n"
+        f"    modulesConnection(first: $first, after: $after_{n}) {{\n"
+        "      pageInfo { hasNextPage endCursor }\n"
+        "      nodes { ...ModuleFields }\n"
+        "    }\n"
+        "  }"
+        for n in range(courses_count)
+    )
+    return f"query ($first: Int, {variables}) {{\n{courses}\n}}\n{GQL_MODULE_FIELDS}"
@@ -0,0 +1,163 @@
+"Rate limiting and retries, driven by the Canvas throttling headers"
+
+# Canvas throttles each access token with a leaky bucket, every response
+# has the remaining quota (`X-Rate-Limit-Remaining`) and the cost of the
+# request (`X-Request-Cost`). When the quota is exhausted, Canvas answers
+# `403 Forbidden (Rate Limit Exceeded)`.
+# https://canvas.instructure.com/doc/api/file.throttling.html
+
+from __future__ import annotations
+
+import random
+import threading
+import time
+from typing import Mapping
+
+import requests
+
+BUCKET_CAPACITY = 700.0
+# Units recovered per second (approximate, Canvas doesn't report it)
+REFILL_RATE = 10.0
+# Cost assumed for a request before Canvas reports one
+INITIAL_REQUEST_COST = 50.0
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every request made with an access token.
+
+    The local estimate of the remaining quota is corrected with each response,
+    and each request reserves the average cost of the previous ones while it's
+    in flight. When the estimate is below `low_water` the requests wait until
+    enough quota has been recovered. It may be used from many threads.
+    """
+
+    def __init__(
+        self,
+        capacity: float = BUCKET_CAPACITY,
+        refill_rate: float = REFILL_RATE,
+        low_water: float = 100.0,
+    ) -> None:
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.low_water = low_water
+        self.request_cost = INITIAL_REQUEST_COST
+        self.throttled_requests = 0
+        self._remaining = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"{type(self).__name__}(remaining={self.remaining:.0f})"
+
+    @property
+    def remaining(self) -> float:
+        "Estimated remaining quota"
+        with self._lock:
+            return self._refill()
+
+    def _refill(self) -> float:
+        now = time.monotonic()
+        elapsed, self._updated_at = now - self._updated_at, now
+        self._remaining = min(
+            self.capacity, self._remaining + elapsed * self.refill_rate
+        )
+        return self._remaining
+
+    def acquire(self) -> float:
+        "Blocks until there's quota for a request, reserves its cost and returns it"
+        while True:
+            with self._lock:
+                available = self._refill() - self.low_water
+                if available >= self.request_cost:
+                    self._remaining -= self.request_cost
+                    return self.request_cost
+                wait = (self.request_cost - available) / self.refill_rate
+            time.sleep(wait)
+
+    def update(self, headers: Mapping[str, str], reserved: float = 0.0):
+        """
+        Corrects the estimate with the throttling headers of a response.
+        Without them (the response wasn't sent by Canvas, like the files of
+        its CDN) the `reserved` cost of the request is returned to the bucket.
+        """
+        remaining = header_float(headers, "X-Rate-Limit-Remaining")
+        cost = header_float(headers, "X-Request-Cost")
+        with self._lock:
+            self._refill()
+            if cost is not None:
+                # Exponential moving average of the cost of the requests
+                self.request_cost = 0.8 * self.request_cost + 0.2 * cost
+            if remaining is not None:
+                self._remaining = remaining
+            else:
+                self._remaining = min(
+                    self.capacity, self._remaining + reserved - (cost or 0.0)
+                )
+
+    def throttled(self):
+        "Registers a throttled request, the quota is exhausted"
+        with self._lock:
+            self.throttled_requests += 1
+            self._remaining = 0.0
+            self._updated_at = time.monotonic()
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, for throttled requests (429 and
+    403 Rate Limit Exceeded), server errors (5xx) and connection errors.
+    Each request may be retried up to `max_retries` times.
+    """
+
+    def __init__(
+        self, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0
+    ) -> None:
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def __repr__(self):
+        return f"{type(self).__name__}(max_retries={self.max_retries})"
+
+    def delay(self, attempt: int, response: requests.Response | None = None) -> float:
+        "Seconds to wait before retrying for the `attempt` time (starting at 0)"
+        # The truth value of a response is `response.ok`, false when throttled
+        retry_after = (
+            response.headers.get("Retry-After") if response is not None else None
+        )
+        if retry_after and retry_after.isdigit():
+            return min(self.max_delay, float(retry_after))
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+def header_float(headers: Mapping[str, str], name: str) -> float | None:
+    "Numeric value of a header, if it's present and valid"
+    try:
+        return float(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+def throttling_headers(response: requests.Response) -> Mapping[str, str]:
+    """
+    Headers of the response sent by Canvas. Downloads are redirected to
+    the file CDN, the throttling headers are in the first response.
+    """
+    for hop in (response, *reversed(response.history)):
+        if "X-Rate-Limit-Remaining" in hop.headers:
+            return hop.headers
+    return {}
+
+
+def is_throttled(response: requests.Response) -> bool:
+    "Checks if Canvas rejected a request because of the rate limit"
+    if response.status_code == 429:
+        return True
+    return response.status_code == 403 and "Rate Limit Exceeded" in response.text
+
+
+def should_retry(response: requests.Response) -> bool:
+    "Checks if a failed request may succeed if it's sent again"
+    return response.status_code in RETRY_STATUS_CODES or is_throttled(response)
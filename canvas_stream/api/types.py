@@ -1,7 +1,7 @@
 "Type annotatins for the CanvasAPI"
 
 from __future__ import annotations
-from typing_extensions import TypedDict
+from typing_extensions import NotRequired, TypedDict
 
 Term = TypedDict("Term", {"name": str})
 
@@ -15,12 +15,18 @@ class RestCourse(TypedDict):
 
 
 # https://canvas.instructure.com/doc/api/files.html
-class RestFile(TypedDict):
-    "Rest File"
-    filename: str
-    id: int
-    updated_at: str
-    url: str
+RestFile = TypedDict(
+    "RestFile",
+    {
+        "content-type": str,
+        "filename": str,
+        "folder_id": int,
+        "id": int,
+        "size": int,
+        "updated_at": str,
+        "url": str,
+    },
+)
 
 
 class RestFolder(TypedDict):
@@ -49,6 +55,8 @@ class GraphQLExternalUrlOrFile(TypedDict):
     type: str
     updatedAt: str
     url: str
+    # Only files have a content type
+    contentType: NotRequired[str]
 
 
 class GraphQLModuleItem(TypedDict):
@@ -0,0 +1,219 @@
+"Command line interface"
+
+# Only `sync` and `daemon` import the modules that make requests, `status`
+# and `pending` answer from the database, so they are fast enough for scripts
+
+from __future__ import annotations
+
+import argparse
+import sys
+from typing import Any, Mapping, Sequence
+
+from .config import DEFAULT_CONFIG_PATH, load_config
+from .db import DataBase, schema
+from .db.api import NOT_SAVED
+from .db.schema import Course, ExternalURL, File
+from .verify import DEFAULT_HASH_WORKERS, requeue, verify
+
+
+def parse_args(argv: Sequence[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="canvas_stream", description="Downloads the files of Canvas courses"
+    )
+    parser.add_argument(
+        "--config",
+        default=DEFAULT_CONFIG_PATH,
+        help=f"configuration file ({DEFAULT_CONFIG_PATH})",
+    )
+    commands = parser.add_subparsers(dest="command")
+
+    sync_parser = commands.add_parser(
+        "sync", help="download the new files (the default command)"
+    )
+    sync_parser.add_argument(
+        "--once",
+        action="store_true",
+        help="run a single iteration and exit (for cron or systemd timers)",
+    )
+    sync_parser.add_argument(
+        "--pause",
+        type=float,
+        default=60,
+        help="minimum seconds between iterations (60)",
+    )
+    sync_parser.add_argument(
+        "--profile",
+        metavar="DIRECTORY",
+        help="run the iterations with cProfile and tracemalloc, and write"
+        " the profiles of each phase to DIRECTORY",
+    )
+    sync_parser.add_argument(
+        "--iterations",
+        type=int,
+        default=1,
+        help="iterations to run with --profile (1)",
+    )
+
+    daemon_parser = commands.add_parser(
+        "daemon", help="sync many Canvas accounts (tenants) in a few processes"
+    )
+    daemon_parser.add_argument(
+        "tenants", help="file with the configuration of each tenant"
+    )
+    daemon_parser.add_argument(
+        "--once", action="store_true", help="sync each tenant once and exit"
+    )
+    daemon_parser.add_argument(
+        "--pause",
+        type=float,
+        default=60,
+        help="minimum seconds between the iterations of a tenant (60)",
+    )
+    daemon_parser.add_argument(
+        "--processes",
+        type=int,
+        help="worker processes the tenants are spread across (`processes` of"
+        " the tenants file, or one per 8 tenants)",
+    )
+
+    commands.add_parser("status", help="show the state of each course")
+
+    pending_parser = commands.add_parser(
+        "pending", help="list the files and urls that haven't been saved"
+    )
+    pending_parser.add_argument(
+        "--limit", type=int, default=0, help="maximum items listed (all)"
+    )
+
+    verify_parser = commands.add_parser(
+        "verify",
+        help="check that the saved files weren't deleted or changed, and mark"
+        " those as not saved (the next sync downloads them again)",
+    )
+    verify_parser.add_argument(
+        "--dry-run", action="store_true", help="only list the files"
+    )
+    verify_parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_HASH_WORKERS,
+        help=f"threads hashing files ({DEFAULT_HASH_WORKERS})",
+    )
+
+    argv = sys.argv[1:] if argv is None else argv
+    args = parser.parse_args(argv)
+    if not args.command:
+        args = parser.parse_args([*argv, "sync"])
+    return args
+
+
+def cli(argv: Sequence[str] | None = None):
+    "Runs the program with the command line arguments"
+    args = parse_args(argv)
+    if args.command == "daemon":
+        return daemon(args)
+    config = load_config(args.config)
+    if args.command == "status":
+        return status(open_database(config))
+    if args.command == "pending":
+        open_database(config)
+        return pending(args.limit)
+    if args.command == "verify":
+        return verify_files(open_database(config), args.workers, args.dry_run)
+    return sync(config, args)
+
+
+def sync(config: dict[str, Any], args: argparse.Namespace):
+    "Downloads the new files"
+    # pylint: disable=import-outside-toplevel
+    from .main import CanvasStream, main
+
+    if not args.profile:
+        return main(args.pause, iterate=not args.once, config=config)
+
+    config["profile"] = args.profile
+    config["profile_iterations"] = args.iterations
+    canvas_stream = CanvasStream(config=config)
+    for _ in range(args.iterations):
+        canvas_stream.run_once(iterating=args.iterations > 1)
+    print(f"Profiles written to {args.profile}")
+
+
+def daemon(args: argparse.Namespace):
+    "Syncs the tenants of a file"
+    # pylint: disable=import-outside-toplevel
+    from .tenants import load_tenants, run_daemon
+
+    tenants = load_tenants(args.tenants)
+    processes = args.processes or max(
+        (tenant.get("processes", 0) for tenant in tenants), default=0
+    )
+    run_daemon(tenants, args.pause, iterate=not args.once, processes=processes)
+
+
+def open_database(config: Mapping[str, Any]) -> DataBase:
+    database = DataBase(
+        config.get("db_name", "canvas.db"), pragmas=config.get("db_pragmas")
+    )
+    database.load_schema(schema)
+    return database
+
+
+def status(database: DataBase):
+    "Prints the state of each course"
+    files_counts = {
+        course_id: (total, not_saved)
+        for course_id, total, not_saved in database.connection.execute(
+            "SELECT course_id, COUNT(*),"
+            f" SUM(CASE WHEN {NOT_SAVED} THEN 1 ELSE 0 END)"
+            " FROM File GROUP BY course_id"
+        )
+    }
+    queue_counts = {
+        course_id: (queued, failed)
+        for course_id, queued, failed in database.connection.execute(
+            "SELECT course_id, COUNT(*),"
+            " SUM(CASE WHEN available_at IS NOT NULL THEN 1 ELSE 0 END)"
+            " FROM QueuedDownload GROUP BY course_id"
+        )
+    }
+    for course in Course.find():
+        total, not_saved = files_counts.get(course.id, (0, 0))
+        queued, failed = queue_counts.get(course.id, (0, 0))
+        print(
+            f"{course.name} ({course.code})\n"
+            f"  saved at: {course.saved_at or 'never'},"
+            f" next check: {course.next_check_at or 'now'}\n"
+            f"  files: {total - not_saved} saved, {not_saved} pending"
+            f" ({queued} queued, {failed} waiting to retry)"
+        )
+
+
+def pending(limit: int = 0):
+    "Prints the files and external urls that haven't been saved"
+    courses = {course.id: course.name for course in Course.find()}
+    listed = 0
+    for table in (File, ExternalURL):
+        for record in table.find_not_saved():
+            if limit and listed == limit:
+                return
+            name = record.name if isinstance(record, File) else record.title
+            course_name = courses.get(record.course_id, record.course_id)
+            print(f"{table.__name__}\t{course_name}\t{name}\t{record.updated_at}")
+            listed += 1
+
+
+def verify_files(database: DataBase, hash_workers: int, dry_run: bool):
+    "Checks the saved files, the missing and damaged ones are marked as not saved"
+    result = verify(File.find(), hash_workers=hash_workers)
+    for label, files in (("missing", result.missing), ("damaged", result.damaged)):
+        for file in files:
+            print(f"{label}\t{file.local_path}")
+    print(
+        f"{result.checked} files checked: {len(result.missing)} missing,"
+        f" {len(result.damaged)} damaged, {len(result.touched)} touched"
+        f" ({result.unknown} saved before the local files were recorded)"
+    )
+    if not dry_run:
+        requeue(result)
+        database.connection.close()
@@ -0,0 +1,15 @@
+"Configuration file"
+
+from __future__ import annotations
+
+from typing import Any
+
+import toml
+
+DEFAULT_CONFIG_PATH = "config.toml"
+
+
+def load_config(path: str = DEFAULT_CONFIG_PATH) -> dict[str, Any]:
+    "Loads a configuration file"
+    with open(path) as file:
+        return toml.load(file)
@@ -8,22 +8,84 @@
 
 from __future__ import annotations
 import sqlite3
-from typing import Any, DefaultDict, Iterator, Type, TypeVar
+from typing import (
+    Any,
+    DefaultDict,
+    Iterable,
+    Iterator,
+    Mapping,
+    Type,
+    TypeVar,
+    Union,
+    get_args,
+    get_origin,
+)
 from collections import defaultdict
+from contextlib import contextmanager
+from functools import cache
+from itertools import islice
+
+from ..metrics import METRICS
 
 
 T = TypeVar("T", bound="Table")
 
+UPSERT_CHUNK_SIZE = 500
+
+# Predicate of the records that must be saved, indexes with this `where` are
+# used by `Table.find_not_saved` (sqlite only uses a partial index if the
+# query has the same condition)
+NOT_SAVED = "(updated_at > saved_at) OR (saved_at IS NULL)"
+
+# https://www.sqlite.org/pragma.html
+DEFAULT_PRAGMAS: dict[str, Any] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    # Negative values are KiB, not pages
+    "cache_size": -16 * 1024,
+    "temp_store": "MEMORY",
+}
+
 PYTHON_TO_SQLITE: DefaultDict[type | None, str] = defaultdict(
     lambda: "TEXT", {None: "NULL", float: "REAL", int: "INTEGER", bool: "INTEGER",},
 )
 
 
+def sqlite_type(python_type: Any) -> str:
+    "SQLite type of an annotation, `Optional[T]` has the type of `T`"
+    if get_origin(python_type) is Union:
+        python_type = next(t for t in get_args(python_type) if t is not type(None))
+    return PYTHON_TO_SQLITE[python_type]
+
+
 def is_table(obj):
     "Checks if an object or a type is a subclass of Table"
     return isinstance(obj, type) and issubclass(obj, Table) and obj is not Table
 
 
+class Index:
+    "Index of a table. With `where` it will be a partial index"
+
+    def __init__(self, *columns: str, where: str | None = None, name: str = ""):
+        self.columns = columns
+        self.where = where
+        self.name = name
+
+    def __repr__(self):
+        where = f" WHERE {self.where}" if self.where else ""
+        return f"<Index {self.name}({', '.join(self.columns)}){where}>"
+
+    def statement(self, table_name: str) -> str:
+        "SQL statement that creates the index"
+        name = self.name or "_".join((table_name, *self.columns))
+        where = f" WHERE {self.where}" if self.where else ""
+        return (
+            f"CREATE INDEX IF NOT EXISTS {name}"
+            f" ON {table_name} ({', '.join(self.columns)}){where}"
+        )
+
+
 class MetaTable(type):
     "MetaClass for the Table class"
 
@@ -43,47 +105,175 @@ class Table(metaclass=MetaTable):
     "DB table helper"
     __db__: DataBase
     __annotations__: dict[str, type]
+    # Secondary indexes (the primary key is always `id`)
+    __indexes__: tuple[Index, ...] = ()
 
     def upsert(self):
-        """SQl upset statement. Used to update not null values."""
-        data = self.__dict__
-        values_to_update = (f"{k}=:{k}" for k, v in data.items() if v)
-        statement = (
-            f"INSERT INTO {type(self).__name__}"
-            f" VALUES ({', '.join(f':{k}' for k in data)})"
+        """SQl upset statement. Used to update not null (nor empty) values."""
+        cls = type(self)
+        with METRICS.timer("db_seconds", op="upsert", table=cls.__name__):
+            self.__db__.connection.execute(cls._upsert_statement(), self.__dict__)
+        self.__db__.identity_map.pop((type(self), self.__dict__["id"]), None)
+        self.__db__.commit()
+
+    @classmethod
+    def upsert_many(cls: Type[T], records: Iterable[T]):
+        """
+        Upserts many records with a single commit (see `upsert`).
+        The records are consumed in chunks, so an iterator of any size may be used.
+        """
+        statement = cls._upsert_statement()
+        identity_map = cls.__db__.identity_map
+        records = iter(records)
+        chunk = [record.__dict__ for record in islice(records, UPSERT_CHUNK_SIZE)]
+        if not chunk:
+            return
+        while chunk:
+            with METRICS.timer("db_seconds", op="upsert_many", table=cls.__name__):
+                cls.__db__.connection.executemany(statement, chunk)
+            for data in chunk:
+                identity_map.pop((cls, data["id"]), None)
+            chunk = [record.__dict__ for record in islice(records, UPSERT_CHUNK_SIZE)]
+        cls.__db__.commit()
+
+    @classmethod
+    def update_many(cls, ids: Iterable[Any], **values: Any):
+        """
+        Sets the columns of `values` of the records with the given `ids`.
+        Unlike `upsert`, a column may be set to null.
+        """
+        statement = cls._update_statement(tuple(sorted(values)))
+        identity_map = cls.__db__.identity_map
+        ids = iter(ids)
+        chunk = list(islice(ids, UPSERT_CHUNK_SIZE))
+        if not chunk:
+            return
+        while chunk:
+            parameters = [{**values, "id": record_id} for record_id in chunk]
+            with METRICS.timer("db_seconds", op="update_many", table=cls.__name__):
+                cls.__db__.connection.executemany(statement, parameters)
+            for record_id in chunk:
+                identity_map.pop((cls, record_id), None)
+            chunk = list(islice(ids, UPSERT_CHUNK_SIZE))
+        cls.__db__.commit()
+
+    @classmethod
+    def update_records(
+        cls: Type[T],
+        records: Iterable[T],
+        columns: tuple[str, ...],
+        unchanged: tuple[str, ...] = (),
+    ):
+        """
+        Sets the `columns` of the records to their values, with a single commit.
+        The records whose `unchanged` columns have other values in the DB (they
+        were modified since they were read) are not updated.
+        """
+        statement = cls._update_statement(columns, unchanged)
+        names = (*columns, *unchanged, "id")
+        identity_map = cls.__db__.identity_map
+        rows = ({name: record.__dict__[name] for name in names} for record in records)
+        chunk = list(islice(rows, UPSERT_CHUNK_SIZE))
+        if not chunk:
+            return
+        while chunk:
+            with METRICS.timer("db_seconds", op="update_records", table=cls.__name__):
+                cls.__db__.connection.executemany(statement, chunk)
+            for data in chunk:
+                identity_map.pop((cls, data["id"]), None)
+            chunk = list(islice(rows, UPSERT_CHUNK_SIZE))
+        cls.__db__.commit()
+
+    # The statements are built once for each class (and columns), so they
+    # are always the same string and sqlite3 reuses its prepared statements
+
+    @classmethod
+    @cache
+    def _upsert_statement(cls) -> str:
+        # `excluded` has the values that would have been inserted,
+        # null (or empty) values keep the current value
+        columns = list(cls.__annotations__)
+        values_to_update = (
+            f"{c}=COALESCE(NULLIF(excluded.{c}, ''), {c})" for c in columns
+        )
+        return (
+            f"INSERT INTO {cls.__name__} ({', '.join(columns)})"
+            f" VALUES ({', '.join(f':{c}' for c in columns)})"
             f" ON CONFLICT (id) DO UPDATE SET {', '.join(values_to_update)}"
         )
-        self.__db__.connection.cursor().execute(statement, data)
-        self.__db__.connection.commit()
+
+    @classmethod
+    @cache
+    def _update_statement(
+        cls, columns: tuple[str, ...], unchanged: tuple[str, ...] = ()
+    ) -> str:
+        values_to_update = ", ".join(f"{c} = :{c}" for c in columns)
+        # `IS` compares null values too
+        where = "".join(f" AND {c} IS :{c}" for c in unchanged)
+        return f"UPDATE {cls.__name__} SET {values_to_update} WHERE id = :id{where}"
+
+    @classmethod
+    @cache
+    def _select_statement(cls, where: tuple[str, ...] = ()) -> str:
+        return (
+            f"SELECT {', '.join(cls.__annotations__)} FROM {cls.__name__}"
+            f"{(' WHERE ' + ' AND '.join(f'{k}=:{k}' for k in where)) if where else ''}"
+        )
 
     @classmethod
     def create_table(cls):
-        "Creates the table"
-        attrs = [f"{n} {PYTHON_TO_SQLITE[t]}" for n, t in cls.__annotations__.items()]
+        "Creates the table, or adds the columns missing in an existing table"
+        attrs = [f"{n} {sqlite_type(t)}" for n, t in cls.__annotations__.items()]
         params = [*attrs, "PRIMARY KEY (id)"]
         statement = f"CREATE TABLE IF NOT EXISTS {cls.__name__} ({', '.join(params)})"
         cls.__db__.connection.cursor().execute(statement)
+        table_info = cls.__db__.connection.execute(f"PRAGMA table_info({cls.__name__})")
+        columns = {column_info[1] for column_info in table_info}
+        for name, column_type in cls.__annotations__.items():
+            if name not in columns:
+                cls.__db__.connection.execute(
+                    f"ALTER TABLE {cls.__name__} ADD COLUMN {name} {sqlite_type(column_type)}"
+                )
+        for index in cls.__indexes__:
+            cls.__db__.connection.execute(index.statement(cls.__name__))
 
     @classmethod
     def find(cls: Type[T], **eq: Any) -> Iterator[T]:
         "SQL find statement"
-        statement = (
-            f"SELECT {', '.join(cls.__annotations__)} FROM {cls.__name__}"
-            f"{(' WHERE ' + 'AND '.join(f'{k}=:{k}' for k in eq)) if eq else ''}"
-        )
-        cursor = cls.__db__.connection.cursor()
-        return ResultIterator(cls, cursor.execute(statement, eq))
+        statement = cls._select_statement(tuple(sorted(eq)))
+        with METRICS.timer("db_seconds", op="find", table=cls.__name__):
+            cursor = cls.__db__.connection.execute(statement, eq)
+        return ResultIterator(cls, cursor)
 
     @classmethod
-    def find_not_saved(cls: Type[T]) -> Iterator[T]:
-        "Find not saved items"
+    def get(cls: Type[T], id: Any) -> T | None:  # pylint: disable=redefined-builtin
+        """
+        Record with the primary key `id`. Records are kept in the identity map
+        of the DB, so they should be treated as read only (`upsert` removes it
+        from the map, the next `get` will read the updated record).
+        """
+        key = (cls, id)
+        identity_map = cls.__db__.identity_map
+        if key not in identity_map:
+            identity_map[key] = next(cls.find(id=id), None)
+        return identity_map[key]  # type: ignore
+
+    @classmethod
+    def find_not_saved(cls: Type[T], **eq: Any) -> Iterator[T]:
+        "Find not saved items (with the values of `eq`)"
+        statement = cls._not_saved_statement(tuple(sorted(eq)))
+        with METRICS.timer("db_seconds", op="find_not_saved", table=cls.__name__):
+            cursor = cls.__db__.connection.execute(statement, eq)
+        return ResultIterator(cls, cursor)
+
+    @classmethod
+    @cache
+    def _not_saved_statement(cls, where: tuple[str, ...] = ()) -> str:
         assert "updated_at" in cls.__annotations__
         assert "saved_at" in cls.__annotations__
-        statement = (
-            f"SELECT {', '.join(cls.__annotations__)} FROM {cls.__name__}"
-            f" WHERE (updated_at > saved_at) OR (saved_at IS NULL)"
-        )
-        return ResultIterator(cls, cls.__db__.connection.cursor().execute(statement))
+        if where:
+            return f"{cls._select_statement(where)} AND ({NOT_SAVED})"
+        return f"{cls._select_statement()} WHERE {NOT_SAVED}"
 
 
 class ResultIterator:
@@ -104,9 +294,57 @@ class ResultIterator:
 class DataBase:
     "Database helper"
 
-    def __init__(self, database: str):
-        self.connection = sqlite3.connect(database)
+    def __init__(
+        self,
+        database: str,
+        *,
+        pragmas: Mapping[str, Any] | None = None,
+        cached_statements: int = 256,
+    ):
+        """
+        Opens a connection to `database`, tuned with `DEFAULT_PRAGMAS`.
+        Those may be replaced with `pragmas` (a `None` value removes it).
+        """
+        self.connection = sqlite3.connect(database, cached_statements=cached_statements)
+        for name, value in {**DEFAULT_PRAGMAS, **(pragmas or {})}.items():
+            if value is not None:
+                self.connection.execute(f"PRAGMA {name} = {value}")
         self.tables: list[Table] = []
+        # Records read with `Table.get`, by table class and id
+        self.identity_map: dict[tuple[type, Any], Table | None] = {}
+        # Number of commits made, useful to measure the cost of an iteration
+        self.commits = 0
+        self._transaction_depth = 0
+
+    def commit(self):
+        "Commits the changes, unless a transaction is open (it will commit at the end)"
+        if self._transaction_depth == 0:
+            with METRICS.timer("db_seconds", op="commit"):
+                self.connection.commit()
+            self.commits += 1
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups every statement inside the context in a single commit.
+        Transactions may be nested, only the outermost one commits, or
+        rollbacks if an exception is raised.
+        """
+        self._transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.connection.rollback()
+                self.identity_map.clear()
+            raise
+        self._transaction_depth -= 1
+        self.commit()
+
+    def clear_identity_map(self):
+        "Forgets the records read with `Table.get`"
+        self.identity_map.clear()
 
     def load_schema(self, schema_module):
         "Load a module schema"
@@ -117,3 +355,12 @@ class DataBase:
                 self.tables.append(m_obj)
         for table in self.tables:
             table.create_table()
+
+    def activate(self):
+        """
+        Binds the tables of the loaded schema to this database again. The
+        tables are bound to a single database at a time, the one that loaded
+        the schema last, so each database must be activated before it's used.
+        """
+        for table in self.tables:
+            setattr(table, "__db__", self)
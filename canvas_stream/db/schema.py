@@ -2,7 +2,7 @@
 
 from dataclasses import dataclass
 from typing import Optional
-from .api import Table
+from .api import NOT_SAVED, Index, Table
 
 
 @dataclass
@@ -14,10 +14,15 @@ class Course(Table):
     is_favorite: Optional[bool] = None
     updated_at: Optional[str] = None
     saved_at: Optional[str] = None
+    # Seconds between checks and next check (see `polling.PollingScheduler`)
+    check_interval: Optional[float] = None
+    next_check_at: Optional[str] = None
 
 
 @dataclass
 class Folder(Table):
+    __indexes__ = (Index("course_id"),)
+
     id: int
     full_name: str
     files_count: int
@@ -29,6 +34,13 @@ class Folder(Table):
 
 @dataclass
 class File(Table):
+    __indexes__ = (
+        Index("course_id"),
+        Index("folder_id"),
+        Index("id", where=NOT_SAVED, name="File_not_saved"),
+        Index("name", "size"),
+    )
+
     id: int
     name: str
     download_url: str
@@ -37,10 +49,23 @@ class File(Table):
     module_name: Optional[str] = None
     updated_at: Optional[str] = None
     saved_at: Optional[str] = None
+    # Size in bytes and hash of the content (used by the blob store)
+    size: Optional[int] = None
+    content_hash: Optional[str] = None
+    content_type: Optional[str] = None
+    # The written file, to check that it wasn't deleted or changed (`verify`)
+    local_path: Optional[str] = None
+    local_size: Optional[int] = None
+    local_mtime: Optional[float] = None
 
 
 @dataclass
 class ExternalURL(Table):
+    __indexes__ = (
+        Index("course_id"),
+        Index("id", where=NOT_SAVED, name="ExternalURL_not_saved"),
+    )
+
     id: int
     url: str
     title: str
@@ -48,3 +73,23 @@ class ExternalURL(Table):
     module_name: str
     updated_at: Optional[str] = None
     saved_at: Optional[str] = None
+
+
+# Files waiting to be downloaded (see `download_queue.DownloadQueue`)
+@dataclass
+class QueuedDownload(Table):
+    __indexes__ = (Index("course_id"), Index("lease_owner"))
+
+    # Id of the file
+    id: int
+    course_id: int
+    updated_at: Optional[str] = None
+    size: Optional[int] = None
+    queued_at: Optional[str] = None
+    # Claims of the file, the failed ones are retried after a backoff
+    attempts: int = 0
+    available_at: Optional[str] = None
+    last_error: Optional[str] = None
+    # Claim that owns the file until `leased_until` (it's free after that)
+    lease_owner: Optional[str] = None
+    leased_until: Optional[str] = None
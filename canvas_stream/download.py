@@ -0,0 +1,315 @@
+"Concurrent download scheduling"
+
+from __future__ import annotations
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import AbstractContextManager, contextmanager
+import http.client
+import os
+from pathlib import Path
+import re
+import sys
+import threading
+import time
+from typing import Any, Callable, Iterator, TypeVar
+from urllib.parse import urlsplit
+
+import requests
+from requests import Response
+
+T = TypeVar("T")
+
+DEFAULT_WORKERS = 4
+DEFAULT_PER_HOST = 4
+# Bytes read at once from a response, the size grows while the reads fill it
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+# Seconds between progress lines
+PROGRESS_INTERVAL = 0.5
+# Range requests made at the same time by a segmented download
+DEFAULT_SEGMENTS = 4
+MIN_SEGMENT_SIZE = 1024 * 1024
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+class HostConnections:
+    """
+    Connections used at the same time to each host, at most `per_host`.
+
+    A download waits until a connection to its host is free. The segments of
+    a segmented download take only the connections that are free, without
+    waiting (the downloads holding the others may be waiting for them).
+    """
+
+    def __init__(self, per_host: int = DEFAULT_PER_HOST) -> None:
+        self.per_host = max(1, per_host)
+        self._in_use: dict[str, int] = {}
+        self._condition = threading.Condition()
+
+    def __repr__(self):
+        return f"{type(self).__name__}(per_host={self.per_host})"
+
+    def in_use(self, url: str) -> int:
+        "Connections used to the host of `url`"
+        with self._condition:
+            return self._in_use.get(urlsplit(url).netloc, 0)
+
+    @contextmanager
+    def slot(self, url: str) -> Iterator[None]:
+        "Blocks until a connection to the host of `url` is available"
+        host = urlsplit(url).netloc
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_use.get(host, 0) < self.per_host)
+            self._in_use[host] = self._in_use.get(host, 0) + 1
+        try:
+            yield
+        finally:
+            self._release(host, 1)
+
+    @contextmanager
+    def extra(self, url: str, wanted: int) -> Iterator[int]:
+        "Takes up to `wanted` free connections to the host of `url`, yields how many"
+        host = urlsplit(url).netloc
+        with self._condition:
+            in_use = self._in_use.get(host, 0)
+            taken = max(0, min(wanted, self.per_host - in_use))
+            self._in_use[host] = in_use + taken
+        try:
+            yield taken
+        finally:
+            self._release(host, taken)
+
+    def _release(self, host: str, connections: int):
+        with self._condition:
+            self._in_use[host] -= connections
+            self._condition.notify_all()
+
+
+class DownloadPool:
+    """
+    A pool of worker threads to download files.
+
+    Only the network and filesystem work should be submitted to the pool,
+    the database must be updated by the thread that created it (the
+    results of the futures are meant to be consumed by that thread).
+    """
+
+    def __init__(
+        self,
+        workers: int = DEFAULT_WORKERS,
+        per_host: int = DEFAULT_PER_HOST,
+        *,
+        connections: HostConnections | None = None,
+    ):
+        self.workers = max(1, workers)
+        # The connections may be shared with the segments of the downloads
+        self.connections = connections or HostConnections(per_host)
+        self.per_host = self.connections.per_host
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="canvas-stream-download"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        # After an error (or Ctrl+C) the downloads that didn't start are cancelled
+        self.shutdown(wait=exc_type is None)
+
+    def shutdown(self, wait=True):
+        """
+        Stops the workers, by default waiting for the submitted downloads.
+        Without `wait` the downloads that didn't start are cancelled.
+        """
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def submit(self, function: Callable[..., T], *args: Any) -> Future[T]:
+        "Runs `function(*args)` in a worker"
+        return self._executor.submit(function, *args)
+
+    def host_slot(self, url: str) -> AbstractContextManager[None]:
+        "Blocks until a connection to the host of `url` is available"
+        return self.connections.slot(url)
+
+
+_buffers = threading.local()
+
+
+def thread_buffer(size: int) -> memoryview:
+    "Buffer of the current thread, reused by each download it makes"
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or len(buffer) < size:
+        buffer = _buffers.buffer = memoryview(bytearray(size))
+    return buffer
+
+
+def direct_reader(response: Response) -> Callable[[memoryview], int] | None:
+    """
+    `readinto` of the `http.client` response wrapped by urllib3, that reads
+    the body without the copies of `iter_content`. None if the body must be
+    decoded, or urllib3 doesn't wrap an `http.client` response (`_fp` is
+    private, other versions may not have it).
+    """
+    if response.headers.get("content-encoding", "identity") != "identity":
+        return None
+    source = getattr(response.raw, "_fp", None)
+    if not isinstance(source, http.client.HTTPResponse):
+        return None
+    return source.readinto
+
+
+def read_chunks(
+    response: Response, max_chunk_size: int = MAX_CHUNK_SIZE
+) -> Iterator[memoryview]:
+    """
+    Chunks of the body of a streamed response. Each chunk is a view of the
+    buffer of the thread, it must be used before the next one is read.
+    The chunks start at `MIN_CHUNK_SIZE` bytes and double while they are
+    filled, up to `max_chunk_size`. The errors are request errors, like
+    the ones of `iter_content`.
+    """
+    readinto = direct_reader(response)
+    if readinto is None:
+        for chunk in response.iter_content(max_chunk_size):
+            yield memoryview(chunk)
+        return
+
+    buffer = thread_buffer(max_chunk_size)
+    chunk_size = min(MIN_CHUNK_SIZE, max_chunk_size)
+    try:
+        while read := readinto(buffer[:chunk_size]):
+            yield buffer[:read]
+            if read == chunk_size:
+                chunk_size = min(2 * chunk_size, max_chunk_size)
+    except TimeoutError as error:
+        response.close()
+        raise requests.ConnectionError(error, response=response) from error
+    except (OSError, http.client.HTTPException) as error:
+        response.close()
+        raise requests.exceptions.ChunkedEncodingError(
+            error, response=response
+        ) from error
+    except BaseException:
+        response.close()
+        raise
+    # The connection may be reused, the whole body was read
+    response.raw.release_conn()
+
+
+def content_range(response: Response) -> tuple[int, int, int] | None:
+    "First byte, last byte and complete size of a partial response"
+    match = CONTENT_RANGE.fullmatch(response.headers.get("content-range", "").strip())
+    if response.status_code != 206 or not match:
+        return None
+    start, end, size = map(int, match.groups())
+    return start, end, size
+
+
+def segment_ranges(
+    start: int, size: int, segments: int, min_segment_size: int = MIN_SEGMENT_SIZE
+) -> list[tuple[int, int]]:
+    "First and last byte of (at most) `segments` parts of the bytes `start` to `size`"
+    length = size - start
+    segments = max(1, min(segments, length // max(1, min_segment_size)))
+    segment_size = -(-length // segments)
+    return [
+        (offset, min(offset + segment_size, size) - 1)
+        for offset in range(start, size, segment_size)
+    ]
+
+
+def preallocate(fd: int, size: int):
+    "Sets the size of a file, reserving its blocks where it's supported"
+    os.ftruncate(fd, size)
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            # Not supported by the filesystem (the file is sparse)
+            pass
+
+
+_seek_lock = threading.Lock()
+
+
+def write_at(fd: int, data: memoryview, offset: int):
+    "Writes all `data` at `offset` of the file, from any thread"
+    while data:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, data, offset)
+        else:
+            with _seek_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, data)
+        data, offset = data[written:], offset + written
+
+
+class ProgressReporter:
+    """
+    Progress of the downloads, shared by the threads that make them.
+
+    A line with the progress of every download in progress is printed at
+    most every `interval` seconds (instead of a line for each chunk), and
+    a line is printed when each download is completed.
+    """
+
+    def __init__(self, interval: float = PROGRESS_INTERVAL) -> None:
+        self.interval = interval
+        # Downloaded and total bytes, by path
+        self._downloads: dict[Path, list[int]] = {}
+        self._lock = threading.Lock()
+        self._printed_at = 0.0
+        self._printed_bytes = 0
+        self._downloaded_bytes = 0
+        self._line_length = 0
+
+    def __repr__(self):
+        return f"{type(self).__name__}({len(self._downloads)} downloads)"
+
+    def start(self, path: Path, total_bytes: int | None, downloaded_bytes: int = 0):
+        "Adds a download (`total_bytes` is unknown if the size wasn't sent)"
+        with self._lock:
+            if not self._downloads:
+                # The speed is measured since the first download started
+                self._printed_at = time.monotonic()
+                self._printed_bytes = self._downloaded_bytes
+            self._downloads[path] = [downloaded_bytes, total_bytes or 0]
+
+    def advance(self, path: Path, downloaded_bytes: int):
+        "Adds the bytes of a downloaded chunk"
+        with self._lock:
+            self._downloads[path][0] += downloaded_bytes
+            self._downloaded_bytes += downloaded_bytes
+            now = time.monotonic()
+            if now - self._printed_at >= self.interval:
+                self._print_status(now)
+
+    def finish(self, path: Path, completed: bool):
+        "Removes a download, printing a line if it was `completed`"
+        with self._lock:
+            self._downloads.pop(path, None)
+            if completed:
+                self._print(f"{1:4.0%} -- {path}", end="\n")
+
+    def _print_status(self, now: float):
+        downloaded = sum(download[0] for download in self._downloads.values())
+        total = sum(download[1] for download in self._downloads.values())
+        elapsed = now - self._printed_at
+        speed = (self._downloaded_bytes - self._printed_bytes) / elapsed
+        self._printed_at, self._printed_bytes = now, self._downloaded_bytes
+        self._print(
+            f"{downloaded / total if total else 0:4.0%} -- {len(self._downloads)}"
+            f" downloads, {downloaded / 2**20:.1f} of {total / 2**20:.1f} MiB"
+            f" ({speed / 2**20:.1f} MiB/s)",
+            end="\r",
+        )
+
+    def _print(self, line: str, end: str):
+        # The last status line is overwritten
+        print(line.ljust(self._line_length), end=end, file=sys.stdout, flush=True)
+        self._line_length = len(line) if end == "\r" else 0
+
+
+# Reporter used by every download
+PROGRESS = ProgressReporter()
@@ -0,0 +1,196 @@
+"Persistent, prioritized queue of the files to download"
+
+from __future__ import annotations
+
+import datetime
+import itertools
+import os
+import time
+from typing import Iterable
+import uuid
+
+from .db import DataBase
+from .db.schema import File, QueuedDownload
+
+# Seconds a claimed file belongs to the claim, unless the lease is renewed
+LEASE_SECONDS = 15 * 60
+# Seconds before a failed file is claimed again, doubled after each attempt
+BASE_BACKOFF = 60
+MAX_BACKOFF = 24 * 60 * 60
+# Files of this size or more are downloaded after the small ones of a course
+LARGE_FILE_SIZE = 100 * 1024 * 1024
+
+PUSH_STATEMENT = """
+INSERT INTO QueuedDownload (id, course_id, updated_at, size, queued_at, attempts)
+VALUES (:id, :course_id, :updated_at, :size, :now, 0)
+ON CONFLICT (id) DO UPDATE SET
+    course_id = excluded.course_id,
+    size = COALESCE(excluded.size, size),
+    updated_at = excluded.updated_at,
+    -- A new version of the file is not penalized by the old failures
+    attempts = CASE WHEN excluded.updated_at > updated_at THEN 0 ELSE attempts END,
+    available_at = CASE
+        WHEN excluded.updated_at > updated_at THEN NULL ELSE available_at
+    END
+"""
+
+# The courses take turns (the first file of each course, then the second...),
+# in each course the small files go first and then the recently updated ones
+PRIORITY_QUERY = """
+SELECT
+    id,
+    updated_at,
+    size,
+    COALESCE(size, 0) >= :large_file_size AS large,
+    ROW_NUMBER() OVER (
+        PARTITION BY course_id
+        ORDER BY COALESCE(size, 0) >= :large_file_size, updated_at DESC, size
+    ) AS turn
+FROM QueuedDownload
+"""
+PRIORITY_ORDER = "ORDER BY turn, large, updated_at DESC, size"
+
+CLAIM_STATEMENT = f"""
+UPDATE QueuedDownload
+SET lease_owner = :owner, leased_until = :leased_until, attempts = attempts + 1
+WHERE id IN (
+    SELECT id FROM (
+        {PRIORITY_QUERY}
+        WHERE (leased_until IS NULL OR leased_until <= :now)
+        AND (available_at IS NULL OR available_at <= :now)
+    )
+    {PRIORITY_ORDER}
+    LIMIT :limit
+)
+"""
+
+# The claimed files, in the same order
+CLAIMED_STATEMENT = f"""
+SELECT id FROM ({PRIORITY_QUERY} WHERE lease_owner = :owner) {PRIORITY_ORDER}
+"""
+
+
+def isoformat(seconds: float = 0) -> str:
+    "Local time in `seconds`, like the other dates saved by the program"
+    return (datetime.datetime.now() + datetime.timedelta(seconds=seconds)).isoformat()
+
+
+def backoff(attempts: int) -> float:
+    "Seconds before a file that failed `attempts` times is claimed again"
+    return min(MAX_BACKOFF, BASE_BACKOFF * 2 ** max(0, attempts - 1))
+
+
+class DownloadQueue:
+    """
+    Files waiting to be downloaded, kept in the `QueuedDownload` table so the
+    order and the failures are preserved between runs.
+
+    Files are claimed in priority order (see `CLAIM_STATEMENT`), each claim
+    leases them atomically for `lease_seconds`, so other workers or processes
+    using the same database don't claim them. A failed file is retried after
+    an exponential backoff, a completed one is removed.
+    """
+
+    def __init__(
+        self,
+        database: DataBase,
+        *,
+        lease_seconds: float = LEASE_SECONDS,
+        large_file_size: int = LARGE_FILE_SIZE,
+    ) -> None:
+        self.database = database
+        self.lease_seconds = lease_seconds
+        self.large_file_size = large_file_size
+        # Each claim has its own owner, prefixed with the owner of the queue
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._claims = itertools.count()
+        self._renewed_at = time.monotonic()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.owner})"
+
+    def push(self, files: Iterable[File]):
+        "Adds the files (with download URL) to the queue, or updates them"
+        now = isoformat()
+        with self.database.transaction():
+            self.database.connection.executemany(
+                PUSH_STATEMENT,
+                (
+                    {
+                        "id": file.id,
+                        "course_id": file.course_id,
+                        "updated_at": file.updated_at,
+                        "size": file.size,
+                        "now": now,
+                    }
+                    for file in files
+                    if file.download_url
+                ),
+            )
+
+    def claim(self, limit: int = -1) -> list[File]:
+        """
+        Leases up to `limit` files (all of them if it's negative), that aren't
+        leased or waiting for a backoff, and returns them in priority order.
+        Queued files that were saved (or removed) meanwhile are completed.
+        """
+        if limit == 0:
+            return []
+        owner = f"{self.owner}-{next(self._claims)}"
+        parameters = {
+            "owner": owner,
+            "now": isoformat(),
+            "leased_until": isoformat(self.lease_seconds),
+            "large_file_size": self.large_file_size,
+            "limit": limit,
+        }
+        with self.database.transaction():
+            connection = self.database.connection
+            connection.execute(CLAIM_STATEMENT, parameters)
+            ids = [row[0] for row in connection.execute(CLAIMED_STATEMENT, parameters)]
+            files = [next(File.find_not_saved(id=file_id), None) for file_id in ids]
+            self.complete(i for i, file in zip(ids, files) if not file)
+        return [file for file in files if file]
+
+    def renew(self, ids: Iterable[int]):
+        "Extends the leases of the files, if half of the lease time has passed"
+        if time.monotonic() - self._renewed_at < self.lease_seconds / 2:
+            return
+        self._renewed_at = time.monotonic()
+        QueuedDownload.update_many(ids, leased_until=isoformat(self.lease_seconds))
+
+    def release(self, ids: Iterable[int]):
+        "Frees the leases of the files, their claim doesn't count as an attempt"
+        with self.database.transaction():
+            self.database.connection.executemany(
+                "UPDATE QueuedDownload SET lease_owner = NULL, leased_until = NULL,"
+                " attempts = MAX(0, attempts - 1) WHERE id = ?",
+                ((i,) for i in ids),
+            )
+
+    def fail(self, file_id: int, error: str):
+        "Frees the lease of a file that failed, it will be claimed after a backoff"
+        queued = next(QueuedDownload.find(id=file_id), None)
+        attempts = queued.attempts if queued else 1
+        QueuedDownload.update_many(
+            [file_id],
+            lease_owner=None,
+            leased_until=None,
+            available_at=isoformat(backoff(attempts)),
+            last_error=error,
+        )
+
+    def complete_saved(self, files: Iterable[File]):
+        "Removes the saved files from the queue, unless a newer version was queued"
+        with self.database.transaction():
+            self.database.connection.executemany(
+                "DELETE FROM QueuedDownload WHERE id = ? AND updated_at IS ?",
+                ((file.id, file.updated_at) for file in files),
+            )
+
+    def complete(self, ids: Iterable[int]):
+        "Removes the files from the queue"
+        with self.database.transaction():
+            self.database.connection.executemany(
+                "DELETE FROM QueuedDownload WHERE id = ?", ((i,) for i in ids)
+            )
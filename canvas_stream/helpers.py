@@ -5,6 +5,8 @@ from __future__ import annotations
 import unicodedata
 import re
 from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
 from string import Template
 from urllib.parse import urlsplit, parse_qs
 
@@ -14,6 +16,7 @@ def naive_datetime(dt_str: str):
     return datetime.fromisoformat(dt_str.strip("Z")).replace(tzinfo=None).isoformat()
 
 
+@lru_cache(maxsize=4096)
 def slugify(value: str) -> str:
     "Makes a string a valid file path"
     # TODO: find a better way to do this
@@ -32,6 +35,12 @@ def slugify(value: str) -> str:
     return re.sub(r"[-]+", "-", value).strip("_-. ")
 
 
+@lru_cache(maxsize=1024)
+def slugify_path(value: str) -> Path:
+    "Makes each part of a path a valid file path (see `slugify`)"
+    return Path(*map(slugify, Path(value).parts))
+
+
 HTML_HYPERLINK_DOCUMENT_TEMPLATE = Template(
     """
 <html>
@@ -2,67 +2,184 @@
 
 from __future__ import annotations
 
+import asyncio
+import concurrent.futures
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from dataclasses import dataclass, field
 import datetime
 from pathlib import Path
 import sys
 import time
-from typing import Any, Mapping
+from typing import Any, Iterable, Iterator, Mapping
 
-import toml
 from requests import RequestException
+from requests.adapters import HTTPAdapter
 
 from . import save
-from .api import CanvasAPI
+from .config import load_config
+from .api import AsyncCanvasAPI, CanvasAPI
+from .api.async_api import DEFAULT_MAX_IN_FLIGHT
+from .api.cache import ResponseCache
+from .api.throttle import RateLimiter, RetryPolicy
+from .api.types import GraphQLCourse, GraphQLModule, RestCourse, RestFile
+from .download import (
+    DEFAULT_PER_HOST,
+    DEFAULT_WORKERS,
+    DownloadPool,
+    HostConnections,
+    content_range,
+)
+from .download_queue import DownloadQueue
 from .helpers import naive_datetime, userfull_download_url_or_empty_str
+from .metrics import METRICS
 from .db import DataBase, schema
-from .db.schema import Course, ExternalURL, File
+from .db.schema import Course, ExternalURL, File, Folder
+from .polling import DEFAULT_MAX_INTERVAL, DEFAULT_MIN_INTERVAL, PollingScheduler
+from .profiling import Profiler
 from .provider import CanvasStreamProvider
+from .store import BlobStore, file_digest
 
 
-def main(pause_time=60, iterate=True):
-    "Runs `CanvasStream().run()`"
-    CanvasStream().run(pause_time, iterate)
+def main(pause_time=60, iterate=True, config: StrMapping | None = None):
+    "Runs `CanvasStream().run()` (or `run_async` if `asyncio` is set in the config)"
+    canvas_stream = CanvasStream(config=config)
+    if canvas_stream.config.get("asyncio", False):
+        return canvas_stream.run_async(pause_time, iterate)
+    return canvas_stream.run(pause_time, iterate)
 
 
 StrMapping = Mapping[str, Any]
 
 
+def connections(config: StrMapping) -> int:
+    "Connections to a host used at the same time with the `config`"
+    # The downloads and their segments share `downloads_per_host` connections
+    return max(10, config.get("downloads_per_host", DEFAULT_PER_HOST))
+
+
+# Downloaded files are marked as saved in the DB in batches of this size
+SAVED_FILES_BATCH_SIZE = 50
+# Bytes of a file compared with the stored contents that may be the same
+STORE_PROBE_SIZE = 64 * 1024
+# Columns of a file set by its download
+SAVED_FILE_COLUMNS = (
+    "saved_at",
+    "size",
+    "content_hash",
+    "local_path",
+    "local_size",
+    "local_mtime",
+)
+
+
+@dataclass
+class DownloadBatch:
+    "Downloads of an iteration, claimed from the queue while the references are saved"
+
+    pool: DownloadPool
+    # Downloads of the claimed files
+    futures: dict[Future[None], File] = field(default_factory=dict)
+    # Downloaded files, their `saved_at` is updated in batches
+    saved_files: list[File] = field(default_factory=list)
+
+
 class CanvasStream:
     "CanvasStream main class"
-    __slots__ = ["database", "requester", "config", "__provider"]
-
-    def __init__(self, *, config: StrMapping = None) -> None:
+    __slots__ = [
+        "database",
+        "requester",
+        "config",
+        "__provider",
+        "_course_paths",
+        "_created_dirs",
+        "_store",
+        "_response_cache",
+        "_scheduler",
+        "_profiler",
+        "_download_queue",
+        "_refresh_due",
+    ]
+
+    def __init__(
+        self,
+        *,
+        config: StrMapping | None = None,
+        adapter: HTTPAdapter | None = None,
+        limiter: RateLimiter | None = None,
+    ) -> None:
         """
         Creates a CanvasStream instance.
 
         If a configuration mapping is not given, it will load
-        the configuration from `config.toml`
+        the configuration from `config.toml`. The connection pools (`adapter`)
+        and the rate `limiter` may be shared with other instances.
         """
 
-        if config:
-            self.config = config
-        else:
-            with open("config.toml") as file:
-                self.config = toml.load(file)
+        self.config = config or load_config()
 
-        self.database = DataBase(self.config.get("db_name", "canvas.db"))
+        self.database = DataBase(
+            self.config.get("db_name", "canvas.db"),
+            pragmas=self.config.get("db_pragmas"),
+        )
         self.database.load_schema(schema)
+        # Files to download, in priority order and kept between runs
+        self._download_queue = DownloadQueue(self.database)
+
+        # Responses revalidated with conditional requests (disabled with "")
+        response_cache = self.config.get("response_cache", "canvas.cache.db")
+        self._response_cache = ResponseCache(response_cache) if response_cache else None
 
         self.requester = CanvasAPI(
-            url=self.config["url"], access_token=self.config["access_token"]
+            url=self.config["url"],
+            access_token=self.config["access_token"],
+            pool_size=connections(self.config),
+            cache=self._response_cache,
+            limiter=limiter,
+            retry_policy=RetryPolicy(self.config.get("max_retries", 5)),
+            adapter=adapter,
         )
 
         self.__provider = CanvasStreamProvider(self.config, self.requester.download)
+        # Paths cached during an iteration
+        self._course_paths: dict[int, Path] = {}
+        self._created_dirs: set[Path] = set()
+
+        # Opt-in content-addressed store, to download duplicated files once
+        blob_store = self.config.get("blob_store")
+        self._store = BlobStore(blob_store) if blob_store else None
+
+        # Each course is checked again after an interval learned from its
+        # updates, when it's due (only while iterating, see `_set_refresh_due`)
+        self._refresh_due = False
+        self._scheduler = PollingScheduler(
+            self.config.get("poll_min_interval", DEFAULT_MIN_INTERVAL),
+            self.config.get("poll_max_interval", DEFAULT_MAX_INTERVAL),
+        )
+
+        # The first iterations may be profiled, to find why they are slow
+        profile = self.config.get("profile")
+        self._profiler = (
+            Profiler(profile, self.config.get("profile_iterations", 1))
+            if profile
+            else None
+        )
 
     def set_provider(self, provider_class: type[CanvasStreamProvider]):
         "Sets a new proveider"
         self.__provider = provider_class(self.config, self.requester.download)
+        self._course_paths.clear()
+
+    def _clear_iteration_caches(self):
+        "Records and paths are cached only during an iteration"
+        self.database.clear_identity_map()
+        self._course_paths.clear()
+        self._created_dirs.clear()
 
     def run(self, pause_time=60, iterate=True):
         "Main program. Run Ctrl+Z to stop it"
         print("Starting the program, stop it with Ctrl+Z")
-        for course in self.requester.favorite_courses():
-            save.favorite_course(course)
+        self._set_refresh_due(iterate)
         if not iterate:
             self._run_iteration()
             return
@@ -75,42 +192,257 @@ class CanvasStream:
         except KeyboardInterrupt:
             sys.exit(0)
 
+    def run_async(self, pause_time=60, iterate=True):
+        "Same as `run`, but using an `AsyncCanvasAPI` to make requests concurrently"
+        print("Starting the program, stop it with Ctrl+Z")
+        self._set_refresh_due(iterate)
+        try:
+            asyncio.run(self._run_async(pause_time, iterate))
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+    def run_once(self, iterating=False):
+        """
+        Runs a single iteration (with `asyncio` if it's set in the config).
+        `iterating` is true when it's one of many iterations of a loop.
+        """
+        self._set_refresh_due(iterating)
+        if self.config.get("asyncio", False):
+            asyncio.run(self._run_async(0, iterate=False))
+        else:
+            self._run_iteration()
+
+    def _set_refresh_due(self, iterate: bool):
+        """
+        The due courses (see `PollingScheduler`) are refreshed while iterating.
+        A single run only refreshes the updated courses, so without changes it
+        takes a single round trip. `refresh_due_courses` overrides it.
+        """
+        self._refresh_due = self.config.get("refresh_due_courses", iterate)
+
+    async def _run_async(self, pause_time: float, iterate: bool):
+        max_in_flight = self.config.get("max_requests_in_flight", DEFAULT_MAX_IN_FLIGHT)
+        async with AsyncCanvasAPI(
+            url=self.config["url"],
+            access_token=self.config["access_token"],
+            max_in_flight=max_in_flight,
+            cache=self._response_cache,
+            # Both clients use the same token, so they share the rate limit
+            limiter=self.requester.limiter,
+            retry_policy=self.requester.retry_policy,
+        ) as requester:
+            if not iterate:
+                return await self._run_iteration_async(requester)
+            while True:
+                print("Running iteration...")
+                await self._run_iteration_async(requester)
+                print(f"Waiting {pause_time} seconds before next iteration")
+                await asyncio.sleep(pause_time)
+
     def _run_iteration(self):
         "Main application loop"
-        courses = self.requester.all_courses()
-        for content in courses:
-            course = next(Course.find(id=content["_id"]), None)
+        start = self._start_iteration()
+        with self._phase("discovery"):
+            # Both requests are made at the same time, an iteration without
+            # changes takes a single round trip
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                favorite_courses = executor.submit(
+                    lambda: list(self.requester.favorite_courses())
+                )
+                courses = self.requester.all_courses()
+                favorite_courses = favorite_courses.result()
+            with self.database.transaction():
+                self._save_favorite_courses(favorite_courses)
+                outdated_courses = list(
+                    filter(None, map(self._outdated_course, courses))
+                )
+
+        # The files are downloaded while the references are saved
+        with self._download_batch() as batch:
+            with self._phase("references"):
+                for files in self._references(outdated_courses):
+                    self._download_queue.push(self._not_saved(files))
+                    self._record_downloads(batch)
+                    self._claim_downloads(batch)
+
+            print("Dowloading new files...")
+            with self._phase("downloads"):
+                self._save_pending_files(batch)
+
+        with self._phase("external_urls"), self.database.transaction():
+            for external_url in ExternalURL.find_not_saved():
+                self._save_external_url(external_url)
+        self._finish_iteration(start)
+
+    async def _run_iteration_async(self, requester: AsyncCanvasAPI):
+        "Main application loop, the courses are updated concurrently"
+        start = self._start_iteration()
+        with self._phase("discovery"):
+            favorite_courses, courses = await asyncio.gather(
+                requester.favorite_courses(), requester.all_courses()
+            )
+            with self.database.transaction():
+                self._save_favorite_courses(favorite_courses)
+                outdated_courses = list(
+                    filter(None, map(self._outdated_course, courses))
+                )
+            modules = await requester.modules_with_items_batch(
+                [course.id for course in outdated_courses], **self._modules_options()
+            )
+
+        async def refresh(course: Course):
+            with METRICS.timer("course_refresh_seconds", course=course.id):
+                await self._update_courses_references_async(
+                    requester, course, modules[course.id]
+                )
+
+        with self._phase("references"):
+            await asyncio.gather(*map(refresh, outdated_courses))
 
-            # The course is not in the list of favorite courses
-            if not course:
-                continue
+        print("Dowloading new files...")
+        with self._phase("downloads"):
+            await self._save_pending_files_async(requester)
+
+        with self._phase("external_urls"), self.database.transaction():
+            for external_url in ExternalURL.find_not_saved():
+                self._save_external_url(external_url)
+        self._finish_iteration(start)
+
+    def _start_iteration(self) -> float:
+        "Prepares an iteration and returns its start time"
+        # Other instances (tenants) may have used the tables
+        self.database.activate()
+        self._clear_iteration_caches()
+        if self._profiler:
+            self._profiler.start_iteration()
+        return time.perf_counter()
+
+    def _phase(self, name: str) -> AbstractContextManager:
+        "Profiles a phase of the iteration (if profiling is enabled)"
+        return self._profiler.phase(name) if self._profiler else nullcontext()
+
+    def _finish_iteration(self, start: float):
+        "Prints the stats of an iteration and exports the metrics"
+        METRICS.observe("iteration_seconds", time.perf_counter() - start)
+        self._print_cache_stats()
+        metrics_jsonl = self.config.get("metrics_jsonl")
+        if metrics_jsonl:
+            METRICS.write_jsonl(metrics_jsonl, commits=self.database.commits)
+        metrics_textfile = self.config.get("metrics_textfile")
+        if metrics_textfile:
+            METRICS.write_prometheus(metrics_textfile)
+
+    def _print_cache_stats(self):
+        cache = self._response_cache
+        if cache:
+            print(
+                f"Response cache: {cache.hits} hits, {cache.misses} misses,"
+                f" {cache.saved_bytes / 1024:.0f} KiB not downloaded"
+            )
+
+    def _save_favorite_courses(self, favorite_courses: Iterable[RestCourse]):
+        "Saves the favorite courses that are new or have changed"
+        for course_data in favorite_courses:
+            course = Course.get(course_data["id"])
+            if (
+                not course
+                or not course.is_favorite
+                or course.name != course_data["name"]
+                or course.code != course_data["course_code"]
+            ):
+                save.favorite_course(course_data)
+
+    def _outdated_course(self, content: GraphQLCourse) -> Course | None:
+        "Updates a favorite course and returns it if its references are outdated"
+        course = next(Course.find(id=content["_id"]), None)
+
+        # The course is not in the list of favorite courses
+        if not course:
+            return None
+
+        previous_updated_at, previous_term = course.updated_at, course.term
+        course.updated_at = naive_datetime(content["updatedAt"])
+        course.term = content["term"]["name"]
+        is_updated = (previous_updated_at, previous_term) != (
+            course.updated_at,
+            course.term,
+        )
 
-            course.updated_at = naive_datetime(content["updatedAt"])
-            course.term = content["term"]["name"]
+        # See if the course hasn't been saved or has been updated, the courses
+        # are also refreshed when they are due (the `updated_at` of a course
+        # doesn't change with every change of its files)
+        is_outdated = not course.saved_at or course.saved_at < course.updated_at
+        is_due = self._refresh_due and self._scheduler.is_due(course)
+        if is_outdated or is_due:
+            changed = previous_updated_at not in (None, course.updated_at)
+            self._scheduler.reschedule(course, changed)
+        # Nothing is written when nothing changed
+        if is_outdated or is_due or is_updated:
             course.upsert()
+        return course if is_outdated or is_due else None
 
-            # See if the course hasn't been saved or has been updated
-            if not course.saved_at or course.saved_at < course.updated_at:
-                print(f"Updating references of {course.name}")
-                self._update_courses_references(course)
+    def _modules_options(self) -> dict[str, int]:
+        options = {
+            "page_size": self.config.get("modules_page_size"),
+            "batch_size": self.config.get("modules_batch_size"),
+        }
+        return {option: value for option, value in options.items() if value}
 
-        print("Dowloading new files...")
-        for file in File.find_not_saved():
-            self._save_file(file)
+    def _references(self, courses: list[Course]) -> Iterator[list[File]]:
+        """
+        Saves the references of the courses while they are requested, yields
+        the files of each saved page (they may be downloaded before the rest
+        of the references are requested). The modules of every course are
+        requested first, with a few GQL queries.
+        """
+        if not courses:
+            return
+        pages = self.requester.iter_modules_pages(
+            [course.id for course in courses], **self._modules_options()
+        )
+        yield from self._committed(save.module_pages(pages))
 
-        for external_url in ExternalURL.find_not_saved():
-            self._save_external_url(external_url)
+        for course in courses:
+            print(f"Updating references of {course.name}")
+            with METRICS.timer("course_refresh_seconds", course=course.id):
+                yield from self._course_references(course)
 
-    def _update_courses_references(self, course: Course):
-        # Check course modules items (files & external URLs)
-        modules = self.requester.modules_with_items(course.id)
-        for module in modules:
-            save.module_items(module["moduleItems"], course.id, module)
+    def _committed(self, pages: Iterable[list[File]]) -> Iterator[list[File]]:
+        """
+        Yields the files of each page after committing it. A transaction must
+        not be open while the files are claimed, or the claims don't commit
+        and the other processes using the queue can't write to the DB.
+        """
+        pages = iter(pages)
+        while True:
+            with self.database.transaction():
+                files = next(pages, None)
+            if files is None:
+                return
+            yield files
 
+    def _course_references(self, course: Course) -> Iterator[list[File]]:
+        """
+        Saves the folders and files of a course, yields the files of each page
+        (each page is committed before, see `_committed`)
+        """
         # Check folders (files)
-        folders = self.requester.folders(course.id)
-        for folder_info in folders:
-            folder = save.folder(folder_info, course.id)
+        folders_info = list(self.requester.folders(course.id))
+        with self.database.transaction():
+            folders = [save.folder(info, course.id) for info in folders_info]
+        if self.config.get("incremental_files", True):
+            # Only the files updated since the last refresh, with one request
+            try:
+                files = self.requester.course_files(
+                    course.id, self._files_updated_since(course)
+                )
+                yield from save.iter_course_files(files, course.id)
+                self._mark_folders_saved(folders)
+                folders = []
+            except RequestException:
+                print(f"Course files of {course.name} not available, using folders")
+
+        for folder in folders:
             # Since checking the files in a folder requieres a request,
             # avoiding making one with the saved_at and updated_at is optimal
             is_saved = folder.saved_at and folder.saved_at >= folder.updated_at
@@ -119,7 +451,7 @@ class CanvasStream:
 
             try:
                 files = self.requester.files(folder.id)
-                save.files(files, folder.id, course.id)
+                yield from save.iter_files(files, folder.id, course.id)
                 folder.saved_at = datetime.datetime.now().isoformat()
                 folder.upsert()
             except RequestException:
@@ -129,25 +461,383 @@ class CanvasStream:
         course.saved_at = datetime.datetime.now().isoformat()
         course.upsert()
 
-    def _save_file(self, file: File):
-        # In some cases, the URL obtained from the API
-        # doesn't have the verifier that makes it posible
-        # to download the file.
-        # `download_url` will be empty in those cases.
-        if not file.download_url:
-            # A now request is made here to try again, but now
-            # only asking for the information of the file
-            file_data = self.requester.file(file.id)
-            file.download_url = userfull_download_url_or_empty_str(file_data["url"])
-            if not file.download_url:
+    def _files_updated_since(self, course: Course) -> str | None:
+        """
+        Most recent `updated_at` of the saved files of the course folders.
+        Canvas dates are used, so it's independent of the local time zone.
+        """
+        files = File.find(course_id=course.id)
+        dates = (file.updated_at for file in files if file.folder_id)
+        return max(filter(None, dates), default=None)
+
+    def _mark_folders_saved(self, folders: list[Folder]):
+        "Marks the folders as saved, after saving the files of the whole course"
+        saved_at = datetime.datetime.now().isoformat()
+        for folder in folders:
+            folder.saved_at = saved_at
+        Folder.upsert_many(folders)
+
+    async def _update_courses_references_async(
+        self, requester: AsyncCanvasAPI, course: Course, modules: list[GraphQLModule]
+    ):
+        print(f"Updating references of {course.name}")
+        folders = await requester.folders(course.id)
+        # Other courses are updated while waiting for a response, so the
+        # transactions must not include an `await`
+        with self.database.transaction():
+            for module in modules:
+                save.module_items(module["moduleItems"], course.id, module)
+            folders_records = [save.folder(info, course.id) for info in folders]
+
+        if self.config.get("incremental_files", True):
+            try:
+                files = await requester.course_files(
+                    course.id, self._files_updated_since(course)
+                )
+            except RequestException:
+                print(f"Course files of {course.name} not available, using folders")
+            else:
+                with self.database.transaction():
+                    save.course_files(files, course.id)
+                    self._mark_folders_saved(folders_records)
+                    course.saved_at = datetime.datetime.now().isoformat()
+                    course.upsert()
                 return
 
-        relative_path = self.__provider.file_relative_path(file)
-        absolute_path = self._complete_path(file.course_id, relative_path)
+        outdated_folders = []
+        for folder in folders_records:
+            is_saved = folder.saved_at and folder.saved_at >= folder.updated_at
+            if folder.files_count != 0 and not is_saved:
+                outdated_folders.append(folder)
+
+        folders_files = await asyncio.gather(
+            *(requester.files(folder.id) for folder in outdated_folders),
+            return_exceptions=True,
+        )
+        with self.database.transaction():
+            for folder, folder_files in zip(outdated_folders, folders_files):
+                if isinstance(folder_files, RequestException):
+                    print(f"Request error with folder {folder.id} ({course.name})")
+                    continue
+                if isinstance(folder_files, BaseException):
+                    raise folder_files
+                save.files(folder_files, folder.id, course.id)
+                folder.saved_at = datetime.datetime.now().isoformat()
+                folder.upsert()
+
+            # Mark the course as saved
+            course.saved_at = datetime.datetime.now().isoformat()
+            course.upsert()
+
+    async def _save_pending_files_async(self, requester: AsyncCanvasAPI):
+        "Downloads the queued files, at most `download_workers` at a time"
+        workers = self.config.get("download_workers", DEFAULT_WORKERS)
+        if not self.__provider.downloads_concurrently():
+            workers = 1
+        saved_files: list[File] = []
+
+        files_without_url = self._files_without_url()
+        if files_without_url:
+            files_data = await requester.files_by_id(
+                [file.id for file in files_without_url], workers=workers
+            )
+            self._set_download_urls(files_without_url, files_data)
+        self._download_queue.push(File.find_not_saved())
+
+        async def save_file(
+            file: File, absolute_path: Path, duplicates: dict[str, int]
+        ):
+            try:
+                await asyncio.to_thread(
+                    self._save_file,
+                    self.__provider.connections,
+                    file,
+                    absolute_path,
+                    duplicates,
+                )
+            except Exception as error:  # pylint: disable=broad-except
+                self._download_failed(file, error)
+                return
+            # Back in the event loop thread, the only one using the DB
+            file.saved_at = datetime.datetime.now().isoformat()
+            saved_files.append(file)
+            if len(saved_files) >= SAVED_FILES_BATCH_SIZE:
+                self._flush_saved_files(saved_files)
+
+        # The files are claimed when a download finishes, in priority order
+        downloads: dict[asyncio.Task, File] = {}
+        try:
+            while (
+                files := self._download_queue.claim(workers - len(downloads))
+            ) or downloads:
+                for file, path, duplicates in self._pending_downloads(files):
+                    task = asyncio.create_task(save_file(file, path, duplicates))
+                    downloads[task] = file
+                if not downloads:
+                    continue
+                done, _ = await asyncio.wait(
+                    downloads, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    del downloads[task]
+                    task.result()
+                self._download_queue.renew(file.id for file in downloads.values())
+        finally:
+            self._flush_saved_files(saved_files)
+            self._download_queue.release(file.id for file in downloads.values())
+
+    @contextmanager
+    def _download_batch(self) -> Iterator[DownloadBatch]:
+        "Pool of workers that download the queued files during an iteration"
+        workers = self.config.get("download_workers", DEFAULT_WORKERS)
+        if not self.__provider.downloads_concurrently():
+            workers = 1
+        pool = DownloadPool(workers, connections=self.__provider.connections)
+        batch = DownloadBatch(pool)
+        try:
+            with batch.pool:
+                yield batch
+        finally:
+            self._flush_saved_files(batch.saved_files)
+            # The files of unfinished downloads can be claimed again
+            self._download_queue.release(file.id for file in batch.futures.values())
+
+    @staticmethod
+    def _not_saved(files: list[File]) -> Iterator[File]:
+        "Current records of the `files` that are not saved"
+        for file in files:
+            yield from File.find_not_saved(id=file.id)
+
+    def _claim_downloads(self, batch: DownloadBatch) -> int:
+        """
+        Submits the next files of the download queue (and computes their
+        paths, they are obtained from the DB). At most eight times the workers
+        are submitted, so the files queued later with a higher priority don't
+        wait for the rest, and they are claimed when half of them finished
+        (each claim sorts the queue and commits). Returns the files claimed.
+        """
+        workers = batch.pool.workers
+        if len(batch.futures) > 4 * workers:
+            return 0
+        files = self._download_queue.claim(8 * workers - len(batch.futures))
+        for file, path, duplicates in self._pending_downloads(files):
+            future = batch.pool.submit(
+                self._save_file, batch.pool.connections, file, path, duplicates
+            )
+            batch.futures[future] = file
+        return len(files)
+
+    def _record_downloads(self, batch: DownloadBatch, wait=False):
+        """
+        Marks the downloaded files as saved, the workers only do the network
+        and filesystem work, then every record is updated by this thread
+        (sqlite connections can't be shared). With `wait` it waits until a
+        download finishes. The failed files are retried after a backoff
+        (see `_download_failed`).
+        """
+        futures = batch.futures
+        if wait and futures:
+            concurrent.futures.wait(futures, return_when=FIRST_COMPLETED)
+        for future in [future for future in futures if future.done()]:
+            file = futures.pop(future)
+            try:
+                future.result()
+            except Exception as error:  # pylint: disable=broad-except
+                self._download_failed(file, error)
+                continue
+            file.saved_at = datetime.datetime.now().isoformat()
+            batch.saved_files.append(file)
+            if len(batch.saved_files) >= SAVED_FILES_BATCH_SIZE:
+                self._flush_saved_files(batch.saved_files)
+        self._download_queue.renew(file.id for file in futures.values())
 
+    def _download_failed(self, file: File, error: Exception):
+        """
+        Records the error of a download, the file is retried after a backoff.
+        Any error (of the network, the filesystem or the provider) only fails
+        its file, the other downloads continue.
+        """
+        description = f"{type(error).__name__}: {error}"
+        print(f"Error with file {file.id}: {description}")
+        self._download_queue.fail(file.id, description)
+
+    def _flush_saved_files(self, saved_files: list[File]):
+        """
+        Records the downloads of the files and removes them from the queue.
+        A file updated while it was downloaded stays not saved (and queued).
+        """
+        with self.database.transaction():
+            File.update_records(
+                saved_files, SAVED_FILE_COLUMNS, unchanged=("updated_at",)
+            )
+            self._download_queue.complete_saved(saved_files)
+        saved_files.clear()
+
+    def _save_pending_files(self, batch: DownloadBatch):
+        "Queues the files that are not saved and downloads the queue"
+        files_without_url = self._files_without_url()
+        if files_without_url:
+            files_data = self.requester.files_by_id(
+                [file.id for file in files_without_url], workers=batch.pool.workers
+            )
+            self._set_download_urls(files_without_url, files_data)
+        self._download_queue.push(File.find_not_saved())
+        while self._claim_downloads(batch) or batch.futures:
+            self._record_downloads(batch, wait=True)
+
+    def _files_without_url(self) -> list[File]:
+        """
+        Not saved files without a download URL. In some cases, the URL obtained
+        from the API doesn't have the verifier that makes it posible to download
+        the file (`download_url` will be empty in those cases).
+        """
+        return [file for file in File.find_not_saved() if not file.download_url]
+
+    def _set_download_urls(self, files: list[File], files_data: dict[int, RestFile]):
+        "Saves the URLs obtained asking only for the information of each file"
+        for file in files:
+            file_data = files_data.get(file.id)
+            if file_data:
+                file.download_url = userfull_download_url_or_empty_str(file_data["url"])
+        with self.database.transaction():
+            File.upsert_many(file for file in files if file.download_url)
+
+    def _pending_downloads(
+        self, files: Iterable[File]
+    ) -> Iterator[tuple[File, Path, dict[str, int]]]:
+        """
+        Not saved `files` that must be downloaded, with their paths and the
+        stored contents that may be the same (see `_stored_duplicates`).
+        """
+        for file in files:
+            # The ones without URL are not downloadable (for now)
+            if not file.download_url:
+                continue
+            yield file, self._file_path(file), self._stored_duplicates(file)
+
+    def _stored_duplicates(self, file: File) -> dict[str, int]:
+        """
+        Sizes of the stored contents (by hash) of other files with the same
+        name and content type, and size (if it's known)
+        """
+        if not self._store or not file.content_type:
+            return {}
+        eq: dict[str, Any] = {"name": file.name, "content_type": file.content_type}
+        if file.size:
+            eq["size"] = file.size
+        return {
+            duplicate.content_hash: duplicate.size
+            for duplicate in File.find(**eq)
+            if duplicate.id != file.id and duplicate.content_hash and duplicate.size
+        }
+
+    def _restore_from_store(
+        self, file: File, path: Path, duplicates: dict[str, int]
+    ) -> bool:
+        """
+        Links a stored duplicate of a file (in a worker). The first and the
+        last bytes of the file are requested, a duplicate is linked only if
+        they and the complete size of the file are the same.
+        """
+        if not self._store or (file.size and file.size <= STORE_PROBE_SIZE):
+            return False
+        head = self._file_range(file.download_url, 0, STORE_PROBE_SIZE - 1)
+        if not head:
+            return False
+        size, first_bytes = head
+        candidates = [
+            digest
+            for digest, stored_size in duplicates.items()
+            if stored_size == size
+            and self._store.has(digest, size)
+            and self._store.has_bytes(digest, 0, first_bytes)
+        ]
+        if not candidates:
+            return False
+        # Files with the same header (like the ones made from a template)
+        # are told apart by their last bytes
+        tail_start = max(0, size - STORE_PROBE_SIZE)
+        tail = self._file_range(file.download_url, tail_start, size - 1)
+        if not tail or tail[0] != size:
+            return False
+        for digest in candidates:
+            if self._store.has_bytes(digest, tail_start, tail[1]):
+                self._store.materialize(digest, path)
+                file.size, file.content_hash = size, digest
+                self._record_local_file(file, path)
+                return True
+        return False
+
+    def _file_range(self, url: str, first: int, last: int) -> tuple[int, bytes] | None:
+        """
+        Complete size and bytes `first` to `last` of a file (with a range
+        request), None if they weren't received
+        """
+        response = self.requester.download(
+            url, headers={"Range": f"bytes={first}-{last}"}
+        )
+        with response:
+            received_range = content_range(response)
+            if received_range and received_range[0] == first:
+                size = received_range[2]
+            elif (
+                not first
+                and response.status_code == 200
+                and "content-length" in response.headers
+            ):
+                # The range was ignored, the start of the complete file is read
+                size = int(response.headers["content-length"])
+            else:
+                return None
+            length = min(size, last + 1) - first
+            data = response.raw.read(length, decode_content=True)
+        if len(data) != length:
+            return None
+        return size, data
+
+    def _file_path(self, file: File) -> Path:
+        with METRICS.timer("path_seconds"):
+            relative_path = self.__provider.file_relative_path(file)
+            return self._complete_path(file.course_id, relative_path)
+
+    def _save_file(
+        self,
+        connections: HostConnections,
+        file: File,
+        absolute_path: Path,
+        duplicates: dict[str, int],
+    ):
+        "Downloads a file, when a connection to its host is free (in a worker)"
+        with connections.slot(file.download_url):
+            self._download_file(file, absolute_path, duplicates)
+
+    def _download_file(
+        self, file: File, absolute_path: Path, duplicates: dict[str, int]
+    ):
+        "Saves a file with the provider and adds it to the blob store (in a worker)"
+        if duplicates and self._restore_from_store(file, absolute_path, duplicates):
+            print(f"Stored -- {absolute_path}")
+            return
         self.__provider.save_file_to_system(file, absolute_path)
-        file.saved_at = datetime.datetime.now().isoformat()
-        file.upsert()
+        # Providers may save the files somewhere else
+        if not absolute_path.is_file():
+            return
+        # The size of the files listed in modules is unknown until downloaded
+        file.size = absolute_path.stat().st_size
+        if self._store:
+            file.content_hash = self._store.add(absolute_path)
+        elif self.config.get("hash_files", False):
+            file.content_hash = file_digest(absolute_path)
+        self._record_local_file(file, absolute_path)
+
+    @staticmethod
+    def _record_local_file(file: File, absolute_path: Path):
+        "Keeps the path, size and modification time of the written file"
+        stat = absolute_path.stat()
+        # `output_path` may be relative, `verify` may run in another directory
+        file.local_path = str(absolute_path.resolve())
+        file.local_size = stat.st_size
+        file.local_mtime = stat.st_mtime
 
     def _save_external_url(self, external_url: ExternalURL):
         relative_path = self.__provider.external_url_relative_path(external_url)
@@ -158,10 +848,15 @@ class CanvasStream:
         external_url.upsert()
 
     def _complete_path(self, course_id: int, relative_path: Path) -> Path:
-        course = next(Course.find(id=course_id))
-        course_path = self.__provider.course_relative_path(course)
-        path = Path(self.config.get("output_path", "canvas")).joinpath(
-            course_path, relative_path
-        )
-        path.parent.mkdir(parents=True, exist_ok=True)
+        if course_id not in self._course_paths:
+            course = Course.get(course_id)
+            if not course:
+                raise ValueError(f"Course {course_id} is not saved")
+            self._course_paths[course_id] = Path(
+                self.config.get("output_path", "canvas")
+            ).joinpath(self.__provider.course_relative_path(course))
+        path = self._course_paths[course_id].joinpath(relative_path)
+        if path.parent not in self._created_dirs:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._created_dirs.add(path.parent)
         return path
@@ -0,0 +1,225 @@
+"Counters and histograms of the work done by the program"
+
+from __future__ import annotations
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import datetime
+from functools import wraps
+import json
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Any, Callable, Iterator, Tuple, TypeVar
+
+T = TypeVar("T")
+
+PREFIX = "canvas_stream_"
+# Seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Bytes per second, from 64 KiB/s to 256 MiB/s
+THROUGHPUT_BUCKETS = tuple(64 * 1024 * 4**i for i in range(7))
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    "Observations counted in cumulative buckets (as Prometheus does)"
+
+    __slots__ = ["buckets", "counts", "count", "sum"]
+
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        "Adds an observation"
+        index = bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self) -> Iterator[tuple[float, int]]:
+        "Upper bound of each bucket with the observations less or equal to it"
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters and histograms, identified by a name
+    and labels. The values are accumulated while the program runs, and may
+    be exported after each iteration to a JSON lines file or to a Prometheus
+    textfile (for the node exporter textfile collector).
+    """
+
+    def __init__(self) -> None:
+        self.counters: dict[tuple[str, LabelsKey], float] = {}
+        self.histograms: dict[tuple[str, LabelsKey], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({len(self.counters) + len(self.histograms)})"
+
+    def inc(self, name: str, value: float = 1, **labels: Any):
+        "Increments a counter"
+        key = (name, labels_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        *,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+        **labels: Any,
+    ):
+        "Adds an observation to a histogram (its `buckets` are set the first time)"
+        key = (name, labels_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels: Any) -> Iterator[None]:
+        "Observes the seconds spent in the block"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def measured(self, name: str, **labels: Any) -> Callable[[T], T]:
+        """
+        Decorator that observes the seconds spent in each call of a function.
+        If the function returns an iterator, the time spent consuming it is
+        observed (when it's exhausted or closed).
+        """
+
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                result = function(*args, **kwargs)
+                if isinstance(result, Iterator):
+                    return self._measured_iterator(name, labels, result, start)
+                self.observe(name, time.perf_counter() - start, **labels)
+                return result
+
+            return wrapper
+
+        return decorator
+
+    def _measured_iterator(
+        self, name: str, labels: dict, iterator: Iterator[T], start: float
+    ) -> Iterator[T]:
+        # Only the time spent in `next` is measured, not the consumer's time
+        elapsed = time.perf_counter() - start
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            self.observe(name, elapsed, **labels)
+
+    def reset(self):
+        "Removes every value"
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self) -> list[dict[str, Any]]:
+        "Current values, as JSON serializable objects"
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "buckets": dict(histogram.cumulative_counts()),
+                }
+                for (name, labels), histogram in sorted(self.histograms.items())
+            ]
+        return counters + histograms
+
+    def write_jsonl(self, path: str | Path, **extra: Any):
+        "Appends a line with the current values (and `extra` fields) to `path`"
+        line = {
+            "time": datetime.datetime.now().isoformat(),
+            **extra,
+            "metrics": self.snapshot(),
+        }
+        with open(path, "a") as file:
+            file.write(json.dumps(line) + "\n")
+
+    def prometheus_text(self) -> str:
+        "Current values in the Prometheus text exposition format"
+        lines: list[str] = []
+        with self._lock:
+            typed: set[str] = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                name = f"{PREFIX}{name}"
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                name = f"{PREFIX}{name}"
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} histogram")
+                for bound, count in histogram.cumulative_counts():
+                    bucket_labels = format_labels((*labels, ("le", str(bound))))
+                    lines.append(f"{name}_bucket{bucket_labels} {count}")
+                bucket_labels = format_labels((*labels, ("le", "+Inf")))
+                lines.append(f"{name}_bucket{bucket_labels} {histogram.count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str | Path):
+        "Writes the current values to a Prometheus textfile, atomically"
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "w") as file:
+            file.write(self.prometheus_text())
+        os.replace(temporary_path, path)
+
+
+def labels_key(labels: dict[str, Any]) -> LabelsKey:
+    "Hashable (and sorted) labels"
+    return tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def format_labels(labels: LabelsKey) -> str:
+    "Labels in the Prometheus format"
+    if not labels:
+        return ""
+    escaped = (
+        (label, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for label, value in labels
+    )
+    return "{" + ",".join(f'{label}="{value}"' for label, value in escaped) + "}"
+
+
+# Registry used by the whole program
+METRICS = Metrics()
@@ -0,0 +1,57 @@
+"Adaptive scheduling of the course checks"
+
+from __future__ import annotations
+
+import datetime
+import random
+
+from .db.schema import Course
+
+DEFAULT_MIN_INTERVAL = 60.0
+DEFAULT_MAX_INTERVAL = 6 * 60 * 60.0
+DEFAULT_JITTER = 0.1
+
+
+class PollingScheduler:
+    """
+    Decides when each course should be refreshed again, even if its
+    `updated_at` didn't change (the courses are still checked for updates
+    in every iteration, with a single request).
+
+    The interval of a course is halved when its `updated_at` changed since the
+    last check and doubled when it didn't, within `min_interval` and
+    `max_interval` (seconds). A random `jitter` (a fraction of the interval)
+    is added, so the courses are not checked in lockstep. The state is kept
+    in the `Course` records, so it's preserved between runs.
+    """
+
+    def __init__(
+        self,
+        min_interval: float = DEFAULT_MIN_INTERVAL,
+        max_interval: float = DEFAULT_MAX_INTERVAL,
+        jitter: float = DEFAULT_JITTER,
+    ) -> None:
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.jitter = jitter
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.min_interval}, {self.max_interval})"
+
+    @staticmethod
+    def is_due(course: Course, now: datetime.datetime | None = None) -> bool:
+        "Checks if the course should be refreshed, even if it wasn't updated"
+        now = now or datetime.datetime.now()
+        return not course.next_check_at or course.next_check_at <= now.isoformat()
+
+    def reschedule(
+        self, course: Course, changed: bool, now: datetime.datetime | None = None
+    ):
+        "Sets the next check of the course (the record is not saved)"
+        now = now or datetime.datetime.now()
+        interval = course.check_interval or self.min_interval
+        interval = interval / 2 if changed else interval * 2
+        interval = min(self.max_interval, max(self.min_interval, interval))
+        delay = interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        course.check_interval = interval
+        course.next_check_at = (now + datetime.timedelta(seconds=delay)).isoformat()
@@ -0,0 +1,99 @@
+"Profiles of the phases of an iteration, with cProfile and tracemalloc"
+
+from __future__ import annotations
+
+import cProfile
+from contextlib import contextmanager
+import io
+from pathlib import Path
+import pstats
+import tracemalloc
+from typing import Iterator
+
+# Functions and allocations listed in the text reports
+DEFAULT_TOP = 30
+
+
+class Profiler:
+    """
+    Profiles the first `iterations` iterations of the program. For each phase
+    of an iteration it writes to `directory`:
+
+    - `NNN-phase.prof`: cProfile stats (for `pstats`, `snakeviz`, ...)
+    - `NNN-phase.txt`: the `top` functions by cumulative time
+    - `NNN-phase.alloc.txt`: the `top` lines by memory allocated in the phase
+
+    cProfile only sees the thread that runs the phase, the work done by the
+    download workers is seen as time waiting for them.
+    """
+
+    def __init__(
+        self, directory: str | Path, iterations: int = 1, top: int = DEFAULT_TOP
+    ) -> None:
+        self.directory = Path(directory)
+        self.iterations = iterations
+        self.top = top
+        self.iteration = 0
+        self._started_tracemalloc = False
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.directory})"
+
+    @property
+    def enabled(self) -> bool:
+        "Checks if the current iteration is profiled"
+        return 0 < self.iteration <= self.iterations
+
+    def start_iteration(self):
+        "Must be called when an iteration starts"
+        self.iteration += 1
+        if self.enabled and not tracemalloc.is_tracing():
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        elif not self.enabled and self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        "Profiles the block, if the iteration is profiled"
+        if not self.enabled:
+            yield
+            return
+        profile = cProfile.Profile()
+        before = tracemalloc.take_snapshot()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._write(name, profile, before, tracemalloc.take_snapshot())
+
+    def _write(
+        self,
+        name: str,
+        profile: cProfile.Profile,
+        before: tracemalloc.Snapshot,
+        after: tracemalloc.Snapshot,
+    ):
+        path = self.directory / f"{self.iteration:03}-{name}"
+        profile.dump_stats(f"{path}.prof")
+
+        stream = io.StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(
+            self.top
+        )
+        Path(f"{path}.txt").write_text(stream.getvalue())
+
+        # The allocations made by tracemalloc itself are not listed
+        ignored = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        differences = after.filter_traces(ignored).compare_to(
+            before.filter_traces(ignored), "lineno"
+        )
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"Traced memory: {current / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB"
+        ]
+        lines.extend(map(str, differences[: self.top]))
+        Path(f"{path}.alloc.txt").write_text("\n".join(lines) + "\n")
@@ -1,13 +1,31 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
+import os
 from pathlib import Path
+import threading
+import time
 from string import Template
 from typing import Any, Callable, Mapping
 from typing_extensions import final
 
-from requests import Response
-from canvas_stream.helpers import slugify
+from requests import RequestException, Response
+from canvas_stream.download import (
+    DEFAULT_PER_HOST,
+    DEFAULT_SEGMENTS,
+    HostConnections,
+    MAX_CHUNK_SIZE,
+    PROGRESS,
+    ProgressReporter,
+    content_range,
+    preallocate,
+    read_chunks,
+    segment_ranges,
+    write_at,
+)
+from canvas_stream.helpers import slugify, slugify_path
 from canvas_stream.db.schema import Course, ExternalURL, File, Folder
+from canvas_stream.metrics import METRICS, THROUGHPUT_BUCKETS
 
 
 HTML_HYPERLINK_DOCUMENT_TEMPLATE = Template(
@@ -26,27 +44,236 @@ def html_redirect(external_url: ExternalURL, path: Path):
     return True
 
 
-def dowload_to_file(request_stream: Response, path: Path, *, chunk_size: int = 4096):
-    "Downloads a file"
+ExternalUrlRecipe = Callable[[ExternalURL, Path], bool]
+# Called with an url (and optional `headers`), see `CanvasAPI.download`
+DowloadFunction = Callable[..., Response]
+
+
+def part_path(path: Path) -> Path:
+    "Path of the temporary file used while `path` is being downloaded"
+    return path.with_name(f"{path.name}.part")
+
+
+def dowload_to_file(
+    request_stream: Response,
+    path: Path,
+    *,
+    chunk_size: int = MAX_CHUNK_SIZE,
+    append=False,
+    progress: ProgressReporter = PROGRESS,
+):
+    """
+    Downloads a file. The data is written to a `.part` file, that is moved
+    to `path` only when the download is complete. With `append` the data
+    is added to the end of the existing `.part` file (resuming a download).
+    The chunks (of up to `chunk_size` bytes) are read into a reused buffer.
+    """
     content_length = request_stream.headers.get("content-length", None)
+    temporary_path = part_path(path)
     path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("wb") as file:
-        if not content_length:
-            print(f"???% -- {path}")
-            file.write(request_stream.content)
-            return
+    downloaded = temporary_path.stat().st_size if append else 0
+    total_bytes = downloaded + int(content_length) if content_length else None
+    start, start_downloaded = time.perf_counter(), downloaded
+    completed = False
+    progress.start(path, total_bytes, downloaded)
+    try:
+        with temporary_path.open("ab" if append else "wb") as file:
+            for chunk in read_chunks(request_stream, chunk_size):
+                file.write(chunk)
+                downloaded += len(chunk)
+                progress.advance(path, len(chunk))
+        completed = not total_bytes or downloaded >= total_bytes
+    finally:
+        progress.finish(path, completed)
+        record_download(downloaded - start_downloaded, time.perf_counter() - start)
 
-        progress = 0
-        total_bytes = int(content_length)
-        for data in request_stream.iter_content(chunk_size=chunk_size):
-            file.write(data)
-            progress += len(data)
-            print(f"{progress / total_bytes:4.0%} -- {path}", end="\r")
-        print(end="\n")
+    # The `.part` file is kept, so the download can be resumed
+    if total_bytes and downloaded < total_bytes:
+        raise RequestException(
+            f"Incomplete download {downloaded}/{total_bytes}: {path}"
+        )
+    os.replace(temporary_path, path)
 
 
-ExternalUrlRecipe = Callable[[ExternalURL, Path], bool]
-DowloadFunction = Callable[[str], Response]
+def record_download(downloaded_bytes: int, seconds: float):
+    "Adds a download to the metrics"
+    METRICS.inc("download_bytes_total", downloaded_bytes)
+    METRICS.observe("download_seconds", seconds)
+    if seconds > 0:
+        METRICS.observe(
+            "download_throughput_bytes",
+            downloaded_bytes / seconds,
+            buckets=THROUGHPUT_BUCKETS,
+        )
+
+
+def response_validator(response: Response) -> str:
+    "Strong `ETag` or `Last-Modified` of a response, to be used with `If-Range`"
+    etag = response.headers.get("etag", "")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("last-modified", "")
+
+
+def resume_request(
+    dowload: DowloadFunction, url: str, offset: int, validator_path: Path
+) -> Response | None:
+    "Requests the rest of a file from `offset`, None if it can't be resumed"
+    headers = {"Range": f"bytes={offset}-", "If-Range": validator_path.read_text()}
+    try:
+        return dowload(url, headers=headers)
+    except RequestException:
+        # Most likely 416 (Range Not Satisfiable), start again
+        return None
+
+
+def starts_at(response: Response, offset: int) -> bool:
+    "Checks that a response has the rest of a file from `offset`, or all of it"
+    if response.status_code != 206:
+        return True
+    received_range = content_range(response)
+    return received_range is not None and received_range[0] == offset
+
+
+def resumable_dowload(dowload: DowloadFunction, url: str, path: Path):
+    """
+    Downloads `url` to `path`, resuming an interrupted download if possible.
+
+    When a download starts, the validator of the response (a strong `ETag` or
+    `Last-Modified`) is saved next to the `.part` file. The download is resumed
+    with a `Range` request, and `If-Range` makes the server send the complete
+    file if it has been changed since then.
+    """
+    temporary_path = part_path(path)
+    validator_path = temporary_path.with_name(f"{temporary_path.name}.validator")
+    offset = 0
+    if temporary_path.exists() and validator_path.exists():
+        offset = temporary_path.stat().st_size
+    response = resume_request(dowload, url, offset, validator_path) if offset else None
+    if response is not None and not starts_at(response, offset):
+        # Appending another part of the file would corrupt it, and resuming
+        # it again would fail the same way
+        response.close()
+        temporary_path.unlink(missing_ok=True)
+        validator_path.unlink(missing_ok=True)
+        response = None
+    if response is None:
+        response, offset = dowload(url), 0
+
+    resumed = response.status_code == 206
+    if resumed and (not offset or not starts_at(response, offset)):
+        response.close()
+        raise RequestException(f"Unexpected range {content_range(response)} of {path}")
+    if not resumed:
+        validator = response_validator(response)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if validator:
+            validator_path.write_text(validator)
+        else:
+            validator_path.unlink(missing_ok=True)
+
+    dowload_to_file(response, path, append=resumed)
+    validator_path.unlink(missing_ok=True)
+
+
+def segmented_dowload(
+    dowload: DowloadFunction,
+    url: str,
+    path: Path,
+    size: int,
+    *,
+    segments: int = DEFAULT_SEGMENTS,
+    progress: ProgressReporter = PROGRESS,
+):
+    """
+    Downloads `url` to `path` with `segments` range requests at the same time.
+    The `.part` file is preallocated and each segment is written at its offset,
+    the file is moved to `path` when every segment has its expected length.
+
+    The first request asks for the first segment (of the expected `size`), the
+    rest are split from the size the server reports. If the server ignores
+    `Range`, the complete file is downloaded from that first response. If the
+    file changes during the download (`If-Range`), it fails and the `.part`
+    file is removed (segmented downloads aren't resumed).
+    """
+    first_end = segment_ranges(0, size, segments)[0][1]
+    response = dowload(url, headers={"Range": f"bytes=0-{first_end}"})
+    received_range = content_range(response)
+    if not received_range or received_range[0] != 0:
+        METRICS.inc("segmented_download_fallbacks_total")
+        if response.status_code == 200:
+            return dowload_to_file(response, path, progress=progress)
+        response.close()
+        return resumable_dowload(dowload, url, path)
+
+    _, first_end, size = received_range
+    validator = response_validator(response)
+    headers = {"If-Range": validator} if validator else {}
+    ranges = [(0, first_end)]
+    if first_end + 1 < size:
+        ranges.extend(segment_ranges(first_end + 1, size, segments - 1))
+
+    temporary_path = part_path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # A partial download of `resumable_dowload` would be appended to
+    validator_path = temporary_path.with_name(f"{temporary_path.name}.validator")
+    validator_path.unlink(missing_ok=True)
+    METRICS.inc("segmented_downloads_total")
+    start, failed = time.perf_counter(), threading.Event()
+    progress.start(path, size)
+
+    def write_segment(response: Response, first: int, last: int) -> int:
+        "Writes the body of a segment response, returns the written bytes"
+        offset = first
+        for chunk in read_chunks(response):
+            if failed.is_set() or offset + len(chunk) > last + 1:
+                raise RequestException(f"Segment {first}-{last} aborted: {path}")
+            write_at(fd, chunk, offset)
+            offset += len(chunk)
+            progress.advance(path, len(chunk))
+        if offset != last + 1:
+            raise RequestException(
+                f"Incomplete segment {first}-{last} ({offset - first} bytes): {path}"
+            )
+        return offset - first
+
+    def dowload_segment(first: int, last: int) -> int:
+        segment_response = dowload(
+            url, headers={"Range": f"bytes={first}-{last}", **headers}
+        )
+        if content_range(segment_response) != (first, last, size):
+            segment_response.close()
+            raise RequestException(f"Changed during the download: {path}")
+        return write_segment(segment_response, first, last)
+
+    downloaded, completed = 0, False
+    try:
+        with temporary_path.open("wb") as file, ThreadPoolExecutor(
+            max_workers=max(1, len(ranges) - 1),
+            thread_name_prefix="canvas-stream-segment",
+        ) as executor:
+            fd = file.fileno()
+            preallocate(fd, size)
+            futures = [executor.submit(dowload_segment, *r) for r in ranges[1:]]
+            try:
+                downloaded += write_segment(response, *ranges[0])
+                downloaded += sum(future.result() for future in futures)
+            except BaseException:
+                failed.set()
+                raise
+            written_size = os.fstat(fd).st_size
+        if downloaded != size or written_size != size:
+            raise RequestException(
+                f"Incomplete download {downloaded}/{size} ({written_size}): {path}"
+            )
+        completed = True
+    except BaseException:
+        temporary_path.unlink(missing_ok=True)
+        raise
+    finally:
+        progress.finish(path, completed)
+        record_download(downloaded, time.perf_counter() - start)
+    os.replace(temporary_path, path)
 
 
 class CanvasStreamProvider:
@@ -59,16 +286,56 @@ class CanvasStreamProvider:
 
     external_url_download_recipes: list[ExternalUrlRecipe] = [html_redirect]
 
+    # `save_file_to_system` is called from several worker threads at the same
+    # time, unless a subclass overrides it (it may use the DB, that only the
+    # main thread can use). Set to `True` or `False` to choose it explicitly.
+    concurrent_downloads: bool | None = None
+
     @final  # (don't override)
     def __init__(self, config: Mapping[str, Any], dowload: DowloadFunction) -> None:
         self.config = config
         # Dowloading a file from canvas might requiere credentials. This could
         # be deleted in the future if files could be downloaded only with the URL.
         self.dowload = dowload
+        # Connections to each host used by the downloads (and their segments)
+        self.connections = HostConnections(
+            config.get("downloads_per_host", DEFAULT_PER_HOST)
+        )
+
+    @final
+    def downloads_concurrently(self) -> bool:
+        "Checks if `save_file_to_system` may be called from many threads"
+        if self.concurrent_downloads is not None:
+            return self.concurrent_downloads
+        save_file = type(self).save_file_to_system
+        return save_file is CanvasStreamProvider.save_file_to_system
 
     def save_file_to_system(self, file: File, path: Path) -> None:
-        "Dowloads a `file` and saves it to `path`"
-        dowload_to_file(self.dowload(file.download_url), path)
+        """
+        Dowloads a `file` and saves it to `path` (called from a worker thread,
+        that holds a connection of `connections`). Files of
+        `segmented_download_threshold` bytes or more are downloaded with the
+        free connections to their host too, unless a partial download can be
+        resumed.
+        """
+        threshold = self.config.get("segmented_download_threshold", 0)
+        if (
+            threshold
+            and file.size
+            and file.size >= threshold
+            and not part_path(path).exists()
+        ):
+            segments = self.config.get("download_segments", DEFAULT_SEGMENTS)
+            with self.connections.extra(file.download_url, segments - 1) as extra:
+                if extra:
+                    return segmented_dowload(
+                        self.dowload,
+                        file.download_url,
+                        path,
+                        file.size,
+                        segments=1 + extra,
+                    )
+        resumable_dowload(self.dowload, file.download_url, path)
 
     def save_external_url_to_system(self, external_url: ExternalURL, path: Path) -> None:
         "Tries each function of `external_url_download_recipes` until one returns `true`"
@@ -84,14 +351,16 @@ class CanvasStreamProvider:
         """
         File path relative to its course directory.
         It will the first available betwen the module name
-        and the complete folder path as a directory.
+        and the complete folder path as a directory (the course
+        directory if the folder isn't saved).
         """
         dir_path = Path()
         if file.module_name:
             dir_path = Path(slugify(file.module_name))
         elif file.folder_id:
-            folder = next(Folder.find(id=file.folder_id))
-            dir_path = Path(*map(slugify, Path(folder.full_name).parts))
+            folder = Folder.get(file.folder_id)
+            if folder:
+                dir_path = slugify_path(folder.full_name)
         return dir_path.joinpath(slugify(file.name))
 
     def external_url_relative_path(self, external_url: ExternalURL) -> Path:
@@ -2,6 +2,10 @@
 
 from __future__ import annotations
 
+from itertools import islice
+from typing import Iterable, Iterator
+
+from .db.api import Table
 from .db.schema import Course, ExternalURL, File, Folder
 
 from .api.types import (
@@ -14,6 +18,9 @@ from .api.types import (
 
 from .helpers import naive_datetime, userfull_download_url_or_empty_str
 
+# Records saved at once by the streaming functions (a page of the REST API)
+STREAM_CHUNK_SIZE = 100
+
 
 def favorite_course(course_data: RestCourse):
     "Saves a favorite course to the database and returns the record"
@@ -29,6 +36,7 @@ def favorite_course(course_data: RestCourse):
 
 def folder(folder_data: RestFolder, course_id: int):
     "Saves a folder to the database and returns the record"
+    saved_folder = Folder.get(folder_data["id"])
     folder_record = Folder(
         id=folder_data["id"],
         full_name=folder_data["full_name"],
@@ -36,6 +44,8 @@ def folder(folder_data: RestFolder, course_id: int):
         course_id=course_id,
         parent_id=folder_data["parent_folder_id"],
         updated_at=naive_datetime(folder_data["updated_at"]),
+        # Keeps when the files of the folder were saved
+        saved_at=saved_folder.saved_at if saved_folder else None,
     )
     folder_record.upsert()
     return folder_record
@@ -43,41 +53,108 @@ def folder(folder_data: RestFolder, course_id: int):
 
 def module_items(
     items: list[GraphQLModuleItem], course_id: int, module: GraphQLModule
-) -> None:
-    "Saves a list of module items to the database"
+) -> list[File]:
+    "Saves a list of module items to the database and returns the files"
+    files_records: list[File] = []
+    external_urls_records: list[ExternalURL] = []
     for item in items:
         if not item["content"]:
             continue
 
         content = item["content"]
         if content["type"] == "File":
-            File(
-                id=int(content["_id"]),
-                course_id=course_id,
-                download_url=userfull_download_url_or_empty_str(content["url"]),
-                name=content["name"],
-                module_name=module["name"],
-                updated_at=naive_datetime(content["updatedAt"]),
-            ).upsert()
+            files_records.append(
+                File(
+                    id=int(content["_id"]),
+                    course_id=course_id,
+                    download_url=userfull_download_url_or_empty_str(content["url"]),
+                    name=content["name"],
+                    module_name=module["name"],
+                    updated_at=naive_datetime(content["updatedAt"]),
+                    content_type=content.get("contentType"),
+                )
+            )
         elif content["type"] == "ExternalUrl":
-            ExternalURL(
-                id=int(content["_id"]),
-                url=content["url"],
-                course_id=course_id,
-                module_name=module["name"],
-                updated_at=naive_datetime(content["updatedAt"]),
-                title=content["name"],
-            ).upsert()
+            external_urls_records.append(
+                ExternalURL(
+                    id=int(content["_id"]),
+                    url=content["url"],
+                    course_id=course_id,
+                    module_name=module["name"],
+                    updated_at=naive_datetime(content["updatedAt"]),
+                    title=content["name"],
+                )
+            )
+    File.upsert_many(files_records)
+    ExternalURL.upsert_many(external_urls_records)
+    return files_records
+
+
+def module_pages(
+    pages: Iterable[tuple[int, list[GraphQLModule]]],
+) -> Iterator[list[File]]:
+    """
+    Saves the pages of modules of many courses (`CanvasAPI.iter_modules_pages`)
+    while they arrive, yields the files of each page after it's saved
+    """
+    for course_id, modules in pages:
+        files_records: list[File] = []
+        for module in modules:
+            files_records.extend(module_items(module["moduleItems"], course_id, module))
+        yield files_records
+
+
+def course_file_record(
+    file_data: RestFile, course_id: int, folder_id: int | None = None
+) -> File:
+    "Record of a file of a course, from any folder unless `folder_id` is given"
+    return File(
+        id=file_data["id"],
+        name=file_data["filename"],
+        download_url=userfull_download_url_or_empty_str(file_data["url"]),
+        updated_at=naive_datetime(file_data["updated_at"]),
+        course_id=course_id,
+        folder_id=folder_id or file_data["folder_id"],
+        size=file_data.get("size"),
+        content_type=file_data.get("content-type"),
+    )
+
+
+def course_files(files_data: Iterable[RestFile], course_id: int):
+    "Saves a list of files of a course (from any folder) to the database"
+    File.upsert_many(
+        course_file_record(file_data, course_id) for file_data in files_data
+    )
 
 
-def files(files_data: list[RestFile], folder_id: int, course_id: int):
+def files(files_data: Iterable[RestFile], folder_id: int, course_id: int):
     "Saves a list of files to the database"
-    for file_data in files_data:
-        File(
-            id=file_data["id"],
-            name=file_data["filename"],
-            download_url=userfull_download_url_or_empty_str(file_data["url"]),
-            updated_at=naive_datetime(file_data["updated_at"]),
-            course_id=course_id,
-            folder_id=folder_id,
-        ).upsert()
+    File.upsert_many(
+        course_file_record(file_data, course_id, folder_id) for file_data in files_data
+    )
+
+
+def upsert_chunks(records: Iterable[Table]) -> Iterator[list]:
+    "Saves the records in chunks while they are iterated, yields each saved chunk"
+    records = iter(records)
+    while chunk := list(islice(records, STREAM_CHUNK_SIZE)):
+        type(chunk[0]).upsert_many(chunk)
+        yield chunk
+
+
+def iter_course_files(
+    files_data: Iterable[RestFile], course_id: int
+) -> Iterator[list[File]]:
+    "Same as `course_files`, but the files are saved (and yielded) while they arrive"
+    return upsert_chunks(
+        course_file_record(file_data, course_id) for file_data in files_data
+    )
+
+
+def iter_files(
+    files_data: Iterable[RestFile], folder_id: int, course_id: int
+) -> Iterator[list[File]]:
+    "Same as `files`, but the files are saved (and yielded) while they arrive"
+    return upsert_chunks(
+        course_file_record(file_data, course_id, folder_id) for file_data in files_data
+    )
@@ -0,0 +1,96 @@
+"Content-addressed store of downloaded files"
+
+from __future__ import annotations
+
+import hashlib
+import os
+from pathlib import Path
+import secrets
+import shutil
+
+HASH_ALGORITHM = "sha256"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path: Path) -> str:
+    "Hex digest of the content of a file"
+    digest = hashlib.new(HASH_ALGORITHM)
+    with path.open("rb") as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(source: Path, destination: Path):
+    """
+    Makes `destination` a hardlink of `source`, or a copy if the filesystem
+    doesn't support it. `destination` is replaced atomically.
+    """
+    # Other processes may link the same blob at the same time (a shared store)
+    temporary_path = destination.with_name(
+        f"{destination.name}.{os.getpid()}-{secrets.token_hex(4)}.link"
+    )
+    try:
+        try:
+            os.link(source, temporary_path)
+        except OSError:
+            shutil.copyfile(source, temporary_path)
+        os.replace(temporary_path, destination)
+    except BaseException:
+        temporary_path.unlink(missing_ok=True)
+        raise
+
+
+class BlobStore:
+    """
+    Stores each downloaded content once, by its hash.
+
+    The files in the output directory are hardlinks of the blobs, so a file
+    that is in many courses uses the disk only once.
+    """
+
+    def __init__(self, root: str | Path) -> None:
+        self.root = Path(root)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.root})"
+
+    def blob_path(self, digest: str) -> Path:
+        "Path of the blob with the `digest` hash"
+        return self.root.joinpath(digest[:2], digest[2:])
+
+    def has(self, digest: str, size: int | None = None) -> bool:
+        "Checks if there is a blob with the `digest` hash (and `size`)"
+        try:
+            blob_size = self.blob_path(digest).stat().st_size
+        except FileNotFoundError:
+            return False
+        return size is None or blob_size == size
+
+    def has_bytes(self, digest: str, offset: int, data: bytes) -> bool:
+        "Checks if the blob with the `digest` hash has `data` at `offset`"
+        try:
+            with self.blob_path(digest).open("rb") as blob:
+                blob.seek(offset)
+                return blob.read(len(data)) == data
+        except FileNotFoundError:
+            return False
+
+    def add(self, path: Path) -> str:
+        """
+        Adds a downloaded file to the store and returns its hash.
+        If the content was already stored, `path` is replaced by a link to it.
+        """
+        digest = file_digest(path)
+        blob = self.blob_path(digest)
+        if blob.exists():
+            link_or_copy(blob, path)
+        else:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy(path, blob)
+        return digest
+
+    def materialize(self, digest: str, path: Path):
+        "Makes `path` a copy (a hardlink, if possible) of a stored blob"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        link_or_copy(self.blob_path(digest), path)
@@ -0,0 +1,174 @@
+"Many Canvas accounts (tenants) synced by one process, or a few of them"
+
+from __future__ import annotations
+
+import heapq
+import math
+import multiprocessing
+from pathlib import Path
+import sys
+import time
+from typing import Any, Sequence
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+from .api.throttle import RateLimiter
+from .config import load_config
+from .main import CanvasStream, connections
+
+StrDict = dict[str, Any]
+
+# Keys of each tenant, by default inside a directory with the tenant name
+TENANT_PATHS = {
+    "db_name": "canvas.db",
+    "response_cache": "canvas.cache.db",
+    "output_path": "canvas",
+}
+# Tenants per worker process when the processes aren't set, the tenants of a
+# process sync one after another, so a slow one delays the rest of them
+TENANTS_PER_PROCESS = 8
+
+
+def load_tenants(path: str) -> list[StrDict]:
+    """
+    Configurations of the tenants listed in a file, as `[[tenants]]` tables.
+    The top level keys are shared by every tenant, except `TENANT_PATHS` that
+    are set for each one (by default in a directory named after the tenant).
+    """
+    config = load_config(path)
+    shared = {key: value for key, value in config.items() if key != "tenants"}
+    if keys := sorted(TENANT_PATHS.keys() & shared.keys()):
+        raise ValueError(f"{', '.join(keys)} must be set for each tenant")
+
+    tenants = []
+    for index, tenant in enumerate(config.get("tenants", [])):
+        tenant = {**shared, **tenant}
+        tenant.setdefault("name", f"tenant-{index}")
+        for key, default in TENANT_PATHS.items():
+            tenant.setdefault(key, str(Path(tenant["name"], default)))
+        tenants.append(tenant)
+    return tenants
+
+
+def host(config: StrDict) -> str:
+    "Canvas host of a tenant"
+    url = config["url"]
+    return urlsplit(url).netloc or url
+
+
+class SharedResources:
+    """
+    Connection pools (one per Canvas host) and rate limiters (one per access
+    token of a host) shared by the tenants of a process. Canvas enforces the
+    rate limit of each token, so tenants with different tokens don't wait
+    for each other.
+    """
+
+    def __init__(self, configs: Sequence[StrDict]) -> None:
+        # The tenants sync one at a time, a pool is as big as the biggest need
+        pool_sizes: dict[str, int] = {}
+        for config in configs:
+            pool_sizes[host(config)] = max(
+                connections(config), pool_sizes.get(host(config), 0)
+            )
+        self.adapters = {
+            canvas_host: HTTPAdapter(pool_maxsize=pool_size)
+            for canvas_host, pool_size in pool_sizes.items()
+        }
+        self.limiters: dict[tuple[str, str], RateLimiter] = {}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(self.adapters)})"
+
+    def canvas_stream(self, config: StrDict) -> CanvasStream:
+        "CanvasStream of a tenant, using the shared resources"
+        for path_key in ("db_name", "response_cache"):
+            if config.get(path_key):
+                Path(config[path_key]).parent.mkdir(parents=True, exist_ok=True)
+        key = (host(config), config["access_token"])
+        return CanvasStream(
+            config=config,
+            adapter=self.adapters[key[0]],
+            limiter=self.limiters.setdefault(key, RateLimiter()),
+        )
+
+
+def run_tenants(configs: Sequence[StrDict], pause_time=60, iterate=True):
+    """
+    Syncs the tenants in this process. A single scheduler runs the iteration
+    of each tenant `pause_time` seconds after its last one. The iterations run
+    one at a time (the tables are bound to the database of a tenant while it
+    syncs), so a long iteration delays the other tenants: spread them across
+    processes (`run_daemon`). A failed iteration doesn't stop the others.
+    """
+    resources = SharedResources(configs)
+    canvas_streams = [resources.canvas_stream(config) for config in configs]
+    # Time and index of the next iteration of each tenant
+    queue = [(0.0, index) for index in range(len(canvas_streams))]
+    try:
+        while queue:
+            due, index = heapq.heappop(queue)
+            wait_time = due - time.monotonic()
+            if wait_time > 0:
+                print(f"Waiting {wait_time:.0f} seconds before next iteration")
+                time.sleep(wait_time)
+            canvas_stream = canvas_streams[index]
+            print(f"Running iteration of {canvas_stream.config['name']}...")
+            try:
+                canvas_stream.run_once(iterating=iterate)
+            except Exception as error:  # pylint: disable=broad-except
+                print(f"Iteration of {canvas_stream.config['name']} failed: {error!r}")
+            if iterate:
+                heapq.heappush(queue, (time.monotonic() + pause_time, index))
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+def partition(configs: Sequence[StrDict], processes: int) -> list[list[StrDict]]:
+    """
+    Splits the tenants in (at most) `processes` groups of similar size. The
+    tenants of a host (and token) are kept together, so they share resources.
+    """
+    configs = sorted(configs, key=lambda config: (host(config), config["access_token"]))
+    processes = max(1, min(processes, len(configs)))
+    bounds = [index * len(configs) // processes for index in range(processes + 1)]
+    return [configs[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def run_daemon(
+    configs: Sequence[StrDict],
+    pause_time=60,
+    iterate=True,
+    processes: int | None = None,
+):
+    """
+    Syncs the tenants, spread across `processes` worker processes (by default
+    one per `TENANTS_PER_PROCESS` tenants)
+    """
+    if not processes:
+        processes = math.ceil(len(configs) / TENANTS_PER_PROCESS)
+    groups = partition(configs, processes)
+    if len(groups) <= 1:
+        return run_tenants(configs, pause_time, iterate)
+
+    print(f"Starting {len(groups)} processes, stop them with Ctrl+Z")
+    workers = [
+        multiprocessing.Process(
+            target=run_tenants,
+            args=(group, pause_time, iterate),
+            name=f"canvas-stream-{index}",
+        )
+        for index, group in enumerate(groups)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # The workers got the interruption too
+        for worker in workers:
+            worker.join()
+    if any(worker.exitcode for worker in workers):
+        sys.exit(1)
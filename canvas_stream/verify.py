@@ -0,0 +1,116 @@
+"Reconciliation of the saved files with the filesystem"
+
+from __future__ import annotations
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import os
+from pathlib import Path
+from typing import Iterable
+
+from .db.schema import File
+from .store import file_digest
+
+DEFAULT_HASH_WORKERS = 4
+
+
+@dataclass
+class Verification:
+    "Result of `verify`"
+
+    checked: int = 0
+    # Saved before their local file was recorded, they can't be verified
+    unknown: int = 0
+    missing: list[File] = field(default_factory=list)
+    damaged: list[File] = field(default_factory=list)
+    # Files with a new modification time, but the same content
+    touched: list[File] = field(default_factory=list)
+
+    @property
+    def requeued(self) -> list[File]:
+        "Files that must be downloaded again"
+        return self.missing + self.damaged
+
+
+def stat_sweep(paths: Iterable[str]) -> dict[str, os.stat_result]:
+    """
+    Stats of the existing `paths`. Each directory is scanned once,
+    instead of making a `stat` call for each path.
+    """
+    names_by_directory: dict[str, set[str]] = defaultdict(set)
+    for path in paths:
+        directory, name = os.path.split(path)
+        names_by_directory[directory].add(name)
+
+    stats: dict[str, os.stat_result] = {}
+    for directory, names in names_by_directory.items():
+        try:
+            with os.scandir(directory or ".") as entries:
+                for entry in entries:
+                    if entry.name in names and entry.is_file():
+                        stats[os.path.join(directory, entry.name)] = entry.stat()
+        except FileNotFoundError:
+            continue
+    return stats
+
+
+def verify(
+    files: Iterable[File], *, hash_workers: int = DEFAULT_HASH_WORKERS
+) -> Verification:
+    """
+    Checks that the local files of the saved `files` weren't deleted or changed.
+
+    A file is missing if it doesn't exist and damaged if its size changed.
+    If only its modification time changed, its content is hashed (in
+    parallel) and compared with `content_hash`, when there's one.
+    The records of the touched files get the new modification time.
+    """
+    result = Verification()
+    # Saved files with their local path
+    saved_files: list[tuple[File, str]] = []
+    for file in files:
+        if not file.saved_at:
+            continue
+        if not file.local_path:
+            result.unknown += 1
+            continue
+        saved_files.append((file, file.local_path))
+    result.checked = len(saved_files)
+
+    stats = stat_sweep(local_path for _, local_path in saved_files)
+    suspects: list[tuple[File, str]] = []
+    for file, local_path in saved_files:
+        stat = stats.get(local_path)
+        if stat is None:
+            result.missing.append(file)
+        elif stat.st_size != file.local_size:
+            result.damaged.append(file)
+        elif stat.st_mtime != file.local_mtime:
+            file.local_mtime = stat.st_mtime
+            if file.content_hash:
+                suspects.append((file, local_path))
+            else:
+                result.touched.append(file)
+
+    with ThreadPoolExecutor(max_workers=max(1, hash_workers)) as executor:
+        digests = executor.map(file_digest, (Path(path) for _, path in suspects))
+        for (file, _), digest in zip(suspects, digests):
+            if digest == file.content_hash:
+                result.touched.append(file)
+            else:
+                result.damaged.append(file)
+    return result
+
+
+def requeue(result: Verification):
+    "Marks the missing and damaged files as not saved, they will be downloaded again"
+    with File.__db__.transaction():
+        File.update_many(
+            (file.id for file in result.requeued),
+            saved_at=None,
+            local_path=None,
+            local_size=None,
+            local_mtime=None,
+        )
+        File.upsert_many(result.touched)
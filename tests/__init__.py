@@ -0,0 +1 @@
+"Tests, run them from the repository root with `python -m pytest`"
@@ -0,0 +1,79 @@
+"Tests of `AsyncCanvasAPI` against the fake Canvas server of the benchmarks"
+
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from benchmarks.fake_canvas import FakeCanvas, Tenant
+from canvas_stream import AsyncCanvasAPI
+
+TENANT = Tenant(courses=2, folders=2, files=150, size=1024, modules=2, items=4)
+
+
+@pytest.fixture(scope="module")
+def server():
+    fake_canvas = FakeCanvas(TENANT).start()
+    yield fake_canvas
+    fake_canvas.shutdown()
+    fake_canvas.server_close()
+
+
+def run(server: FakeCanvas, function):
+    "Runs `function(client)` with a client of the `server`"
+
+    async def main():
+        async with AsyncCanvasAPI(server.url, "token", max_in_flight=8) as client:
+            return await function(client)
+
+    return asyncio.run(main())
+
+
+def test_courses(server):
+    courses = run(server, lambda client: client.all_courses())
+    favorites = run(server, lambda client: client.favorite_courses())
+    assert [course["_id"] for course in courses] == ["1", "2"]
+    assert [course["id"] for course in favorites] == [1, 2]
+
+
+def test_paginated_lists_in_flight(server):
+    async def folders_files(client: AsyncCanvasAPI):
+        folder_ids = [
+            folder_id
+            for course_id in TENANT.course_ids()
+            for folder_id in TENANT.folder_ids(course_id)
+        ]
+        return await asyncio.gather(*map(client.files, folder_ids))
+
+    folders = run(server, folders_files)
+    assert [len(files) for files in folders] == [150] * 4
+    assert len({file["id"] for files in folders for file in files}) == 600
+
+
+def test_modules(server):
+    modules = run(
+        server,
+        lambda client: client.modules_with_items_batch(
+            TENANT.course_ids(), batch_size=1
+        ),
+    )
+    assert sorted(modules) == [1, 2]
+    assert all(len(course_modules) == 2 for course_modules in modules.values())
+
+
+def test_download(server):
+    async def download(client: AsyncCanvasAPI):
+        response = await client.download(f"{server.url}/files/1000000/download")
+        return response.content
+
+    assert run(server, download) == TENANT.content(1_000_000)
+
+
+def test_close_stops_the_sync_client(server):
+    async def close(client: AsyncCanvasAPI):
+        return client
+
+    client = run(server, close)
+    with pytest.raises(RuntimeError):
+        client.sync_api._pages_executor.submit(print)
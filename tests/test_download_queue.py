@@ -0,0 +1,158 @@
+"Tests of the persistent download queue"
+
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+from benchmarks.fake_canvas import FakeCanvas, Tenant
+from canvas_stream import CanvasStream, CanvasStreamProvider
+from canvas_stream.db import DataBase, schema
+from canvas_stream.db.schema import File, QueuedDownload
+from canvas_stream.download_queue import (
+    BASE_BACKOFF,
+    MAX_BACKOFF,
+    DownloadQueue,
+    backoff,
+)
+
+LARGE = 100
+
+
+@pytest.fixture
+def database(tmp_path: Path):
+    database = DataBase(str(tmp_path / "canvas.db"))
+    database.load_schema(schema)
+    yield database
+    database.connection.close()
+
+
+@pytest.fixture
+def queue(database: DataBase):
+    return DownloadQueue(database, large_file_size=LARGE)
+
+
+def queued_file(queue: DownloadQueue, file_id: int, course_id=1, size=1, version=1):
+    "Saves a file that isn't saved (of the `version`) and adds it to the queue"
+    file = File(
+        id=file_id,
+        name=f"file {file_id}.pdf",
+        download_url=f"https://canvas.test/files/{file_id}/download",
+        course_id=course_id,
+        size=size,
+        updated_at=f"2021-01-0{version}T00:00:00",
+    )
+    file.upsert()
+    queue.push([file])
+    return file
+
+
+def test_claim_order(queue):
+    queued_file(queue, 1, course_id=1, version=1)
+    queued_file(queue, 2, course_id=1, version=2)
+    queued_file(queue, 3, course_id=1, size=LARGE, version=3)
+    queued_file(queue, 4, course_id=2, version=1)
+    # The courses take turns, the small and recent files of each one first
+    assert [file.id for file in queue.claim()] == [2, 4, 1, 3]
+
+
+def test_claimed_files_are_leased(database, queue):
+    queued_file(queue, 1)
+    queued_file(queue, 2)
+    assert [file.id for file in queue.claim(1)] == [1]
+    # Other processes using the same database don't claim them
+    assert [file.id for file in DownloadQueue(database).claim()] == [2]
+    assert DownloadQueue(database).claim() == []
+
+
+def test_expired_leases_are_claimed_again(database):
+    expired = DownloadQueue(database, lease_seconds=-1)
+    queued_file(expired, 1)
+    assert [file.id for file in expired.claim()] == [1]
+    assert [file.id for file in DownloadQueue(database).claim()] == [1]
+
+
+def test_released_files_are_claimed_again(queue):
+    queued_file(queue, 1)
+    queue.release(file.id for file in queue.claim())
+    assert [file.id for file in queue.claim()] == [1]
+    assert next(QueuedDownload.find(id=1)).attempts == 1
+
+
+def test_failed_files_wait_for_a_backoff(queue):
+    queued_file(queue, 1)
+    queue.claim()
+    queue.fail(1, "OSError: [Errno 28] No space left on device")
+    assert queue.claim() == []
+    queued = next(QueuedDownload.find(id=1))
+    assert queued.lease_owner is None and queued.available_at
+    assert queued.last_error.startswith("OSError")
+
+
+def test_backoff_doubles_up_to_a_day():
+    assert backoff(1) == BASE_BACKOFF
+    assert backoff(2) == 2 * BASE_BACKOFF
+    assert backoff(100) == MAX_BACKOFF
+
+
+def test_new_versions_are_not_penalized(queue):
+    queued_file(queue, 1)
+    queue.claim()
+    queue.fail(1, "error")
+    queued_file(queue, 1, version=2)
+    assert [file.id for file in queue.claim()] == [1]
+
+
+def test_saved_files_are_completed(queue):
+    file = queued_file(queue, 1)
+    queue.claim()
+    queue.complete_saved([file])
+    assert not list(QueuedDownload.find())
+
+
+def test_files_updated_during_the_download_stay_queued(queue):
+    claimed = queued_file(queue, 1)
+    queue.claim()
+    queued_file(queue, 1, version=2)
+    queue.complete_saved([claimed])
+    assert [queued.id for queued in QueuedDownload.find()] == [1]
+
+
+def test_files_saved_meanwhile_are_completed(queue):
+    file = queued_file(queue, 1)
+    File.update_many([file.id], saved_at="2021-02-01T00:00:00")
+    assert queue.claim() == []
+    assert not list(QueuedDownload.find())
+
+
+def test_a_failed_file_doesnt_stop_the_others(tmp_path):
+    tenant = Tenant(courses=1, folders=1, files=6, size=1024, modules=0)
+    failing_id = tenant.file_ids(tenant.folder_ids(1)[0])[2]
+
+    class FailingProvider(CanvasStreamProvider):
+        def save_file_to_system(self, file: File, path: Path) -> None:
+            if file.id == failing_id:
+                raise OSError(36, "File name too long")
+            super().save_file_to_system(file, path)
+
+    server = FakeCanvas(tenant).start()
+    config = {
+        "url": server.url,
+        "access_token": "token",
+        "db_name": str(tmp_path / "canvas.db"),
+        "response_cache": "",
+        "output_path": str(tmp_path / "canvas"),
+    }
+    try:
+        canvas_stream = CanvasStream(config=config)
+        canvas_stream.set_provider(FailingProvider)
+        canvas_stream.run_once()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert sum(1 for file in File.find() if file.saved_at) == 5
+    [failed] = QueuedDownload.find()
+    assert failed.id == failing_id and failed.available_at
+    assert failed.lease_owner is None and failed.last_error.startswith("OSError")
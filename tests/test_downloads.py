@@ -0,0 +1,258 @@
+"Tests of the resumed and segmented downloads against the fake Canvas"
+
+from __future__ import annotations
+
+import hashlib
+from pathlib import Path
+
+import pytest
+from requests import RequestException, Response
+
+from benchmarks.fake_canvas import FakeCanvas, Tenant, new_version
+from canvas_stream.api import CanvasAPI
+from canvas_stream.db.schema import File
+from canvas_stream.download import DownloadPool, ProgressReporter
+from canvas_stream.provider import (
+    CanvasStreamProvider,
+    dowload_to_file,
+    part_path,
+    resumable_dowload,
+    segmented_dowload,
+)
+
+# Files of 4 segments (see `MIN_SEGMENT_SIZE`)
+TENANT = Tenant(courses=1, folders=1, files=30, size=4 * 1024 * 1024, modules=0)
+FILE_IDS = iter(TENANT.file_ids(TENANT.folder_ids(1)[0]))
+
+
+@pytest.fixture(scope="module")
+def server():
+    fake_canvas = FakeCanvas(TENANT).start()
+    yield fake_canvas
+    fake_canvas.shutdown()
+    fake_canvas.server_close()
+
+
+@pytest.fixture(scope="module")
+def api(server: FakeCanvas):
+    client = CanvasAPI(server.url, "token")
+    yield client
+    client.close()
+
+
+def etag(content: bytes) -> str:
+    "ETag of a file of the fake Canvas"
+    return f'"{hashlib.md5(content).hexdigest()}"'
+
+
+def change_file(file_id: int) -> bytes:
+    "Makes a new version of a file of the fake Canvas, returns its content"
+    TENANT.file_versions[file_id] = new_version(TENANT.file_versions.get(file_id, 0))
+    return TENANT.content(file_id)
+
+
+def interrupted_download(
+    server: FakeCanvas, path: Path, downloaded: int, changed=False
+):
+    """
+    Url and content of a file (a different one in each test), with the first
+    `downloaded` bytes in the `.part` file of `path` and its validator.
+    With `changed`, the file has a new version since then.
+    """
+    file_id = next(FILE_IDS)
+    content = TENANT.content(file_id)
+    temporary_path = part_path(path)
+    temporary_path.write_bytes(content[:downloaded])
+    validator_path = temporary_path.with_name(f"{temporary_path.name}.validator")
+    validator_path.write_text(etag(content))
+    if changed:
+        content = change_file(file_id)
+    return f"{server.url}/files/{file_id}/download", content
+
+
+def recorded(api: CanvasAPI, responses: list[Response]):
+    "Download function that records the responses"
+
+    def dowload(url: str, headers: dict[str, str] | None = None):
+        response = api.download(url, headers=headers)
+        responses.append(response)
+        return response
+
+    return dowload
+
+
+def test_resume_appends_the_rest(server, api, tmp_path):
+    path = tmp_path / "file.pdf"
+    url, content = interrupted_download(server, path, 1000)
+    responses: list[Response] = []
+    resumable_dowload(recorded(api, responses), url, path)
+    assert path.read_bytes() == content
+    assert [response.status_code for response in responses] == [206]
+    assert responses[0].headers["Content-Length"] == str(len(content) - 1000)
+
+
+def test_resume_of_a_changed_file_starts_again(server, api, tmp_path):
+    path = tmp_path / "file.pdf"
+    url, content = interrupted_download(server, path, 1000, changed=True)
+    responses: list[Response] = []
+    resumable_dowload(recorded(api, responses), url, path)
+    # `If-Range` makes the server send the new version
+    assert path.read_bytes() == content
+    assert [response.status_code for response in responses] == [200]
+
+
+def test_resume_past_the_end_starts_again(server, api, tmp_path):
+    path = tmp_path / "file.pdf"
+    url, content = interrupted_download(server, path, TENANT.size)
+    part_path(path).write_bytes(content + b"garbage")
+    responses: list[Response] = []
+    # The 416 (Range Not Satisfiable) response raises, it isn't recorded
+    resumable_dowload(recorded(api, responses), url, path)
+    assert path.read_bytes() == content
+    assert [response.status_code for response in responses] == [200]
+    assert not part_path(path).exists()
+
+
+def test_resume_with_an_unexpected_range_starts_again(server, api, tmp_path):
+    path = tmp_path / "file.pdf"
+    url, content = interrupted_download(server, path, 1000)
+
+    def shifted_range(url: str, headers: dict[str, str] | None = None):
+        if headers and "Range" in headers:
+            headers = {**headers, "Range": "bytes=10-"}
+        return api.download(url, headers=headers)
+
+    resumable_dowload(shifted_range, url, path)
+    assert path.read_bytes() == content
+    assert not part_path(path).exists()
+
+
+def test_segmented_download_without_ranges(server, api, tmp_path):
+    file_id = next(FILE_IDS)
+    path = tmp_path / "file.pdf"
+    responses: list[Response] = []
+
+    def ignored_range(url: str, headers: dict[str, str] | None = None):
+        headers = {k: v for k, v in (headers or {}).items() if k != "Range"}
+        return recorded(api, responses)(url, headers=headers)
+
+    url = f"{server.url}/files/{file_id}/download"
+    segmented_dowload(ignored_range, url, path, TENANT.size, segments=4)
+    # The complete file is downloaded from the first response
+    assert path.read_bytes() == TENANT.content(file_id)
+    assert [response.status_code for response in responses] == [200]
+
+
+def test_segmented_download_of_a_changed_file_fails(server, api, tmp_path):
+    file_id = next(FILE_IDS)
+    path = tmp_path / "file.pdf"
+    responses: list[Response] = []
+
+    def changing(url: str, headers: dict[str, str] | None = None):
+        response = recorded(api, responses)(url, headers=headers)
+        if len(responses) == 1:
+            change_file(file_id)
+        return response
+
+    url = f"{server.url}/files/{file_id}/download"
+    with pytest.raises(RequestException, match="Changed during the download"):
+        segmented_dowload(changing, url, path, TENANT.size, segments=4)
+    # `If-Range` makes the server send the new version to the other segments
+    assert {response.status_code for response in responses[1:]} == {200}
+    assert not path.exists() and not part_path(path).exists()
+
+
+class InterruptedBody:
+    "Body of a response (of unknown size) that fails after its first read"
+
+    def __init__(self) -> None:
+        self.reads = 0
+
+    def read(self, *_):
+        self.reads += 1
+        if self.reads > 1:
+            raise RequestException("Connection reset")
+        return b"partial"
+
+
+def test_failed_downloads_are_not_reported_complete(tmp_path, capsys):
+    response = Response()
+    response.status_code, response.raw = 200, InterruptedBody()
+    path = tmp_path / "file.pdf"
+    with pytest.raises(RequestException):
+        dowload_to_file(response, path, progress=ProgressReporter())
+    assert str(path) not in capsys.readouterr().out
+    assert not path.exists() and part_path(path).read_bytes() == b"partial"
+
+
+@pytest.fixture
+def slow_server(server: FakeCanvas):
+    "The server, sending the downloads slowly (they are sent at the same time)"
+    server.reset_counts()
+    server.download_delay = 0.01
+    yield server
+    server.download_delay = 0.0
+
+
+def segmented_provider(api: CanvasAPI, per_host: int) -> CanvasStreamProvider:
+    "Provider that downloads every file with 4 segments"
+    config = {
+        "segmented_download_threshold": 1,
+        "download_segments": 4,
+        "downloads_per_host": per_host,
+    }
+    return CanvasStreamProvider(config, api.download)
+
+
+def download_files(
+    server: FakeCanvas, provider: CanvasStreamProvider, files: int, directory: Path
+) -> dict[Path, bytes]:
+    "Downloads the next `files` files with 4 workers, returns their contents"
+    pool = DownloadPool(4, connections=provider.connections)
+
+    def save(file: File, path: Path):
+        with pool.host_slot(file.download_url):
+            provider.save_file_to_system(file, path)
+
+    contents = {}
+    with pool:
+        futures = []
+        for _ in range(files):
+            file_id = next(FILE_IDS)
+            file = File(
+                id=file_id,
+                name=f"{file_id}.pdf",
+                download_url=f"{server.url}/files/{file_id}/download",
+                course_id=1,
+                size=TENANT.size,
+            )
+            contents[directory / file.name] = TENANT.content(file_id)
+            futures.append(pool.submit(save, file, directory / file.name))
+        for future in futures:
+            future.result()
+    return contents
+
+
+def test_segments_use_the_free_connections(slow_server, api, tmp_path):
+    contents = download_files(slow_server, segmented_provider(api, 4), 1, tmp_path)
+    assert all(path.read_bytes() == content for path, content in contents.items())
+    assert slow_server.max_downloads_in_flight == 4
+
+
+def test_segments_dont_exceed_the_connections_per_host(slow_server, api, tmp_path):
+    contents = download_files(slow_server, segmented_provider(api, 2), 6, tmp_path)
+    assert all(path.read_bytes() == content for path, content in contents.items())
+    assert slow_server.max_downloads_in_flight == 2
+
+
+def test_providers_that_save_the_files_download_one_by_one():
+    class SavingProvider(CanvasStreamProvider):
+        def save_file_to_system(self, file: File, path: Path) -> None:
+            pass
+
+    class ThreadSafeProvider(SavingProvider):
+        concurrent_downloads = True
+
+    assert CanvasStreamProvider({}, print).downloads_concurrently()
+    assert not SavingProvider({}, print).downloads_concurrently()
+    assert ThreadSafeProvider({}, print).downloads_concurrently()
@@ -0,0 +1,70 @@
+"Tests of the response cache against the fake Canvas"
+
+# pylint: disable=protected-access
+
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+from benchmarks.fake_canvas import FakeCanvas, Tenant, new_version
+from canvas_stream.api import CanvasAPI
+from canvas_stream.api.cache import ResponseCache
+
+TENANT = Tenant(courses=1, folders=1, files=5, size=1024, modules=0)
+FOLDER_ID = TENANT.folder_ids(1)[0]
+
+
+@pytest.fixture(scope="module")
+def server():
+    fake_canvas = FakeCanvas(TENANT).start()
+    yield fake_canvas
+    fake_canvas.shutdown()
+    fake_canvas.server_close()
+
+
+@pytest.fixture
+def cache(tmp_path: Path):
+    return ResponseCache(str(tmp_path / "responses.db"))
+
+
+@pytest.fixture
+def api(server: FakeCanvas, cache: ResponseCache):
+    server.reset_counts()
+    client = CanvasAPI(server.url, "token", cache=cache)
+    yield client
+    client.close()
+
+
+def test_unchanged_responses_are_revalidated(server, api, cache):
+    files = list(api.files(FOLDER_ID))
+    assert cache.hits == 0 and "not_modified" not in server.requests
+    assert list(api.files(FOLDER_ID)) == files
+    assert cache.hits == server.requests["not_modified"] == 1
+    assert cache.saved_bytes > 0
+
+
+def test_changed_responses_are_sent_again(server, api, cache):
+    files = list(api.files(FOLDER_ID))
+    file_id = files[0]["id"]
+    TENANT.file_versions[file_id] = new_version(TENANT.file_versions.get(file_id, 0))
+    changed_files = list(api.files(FOLDER_ID))
+    assert changed_files[0]["updated_at"] != files[0]["updated_at"]
+    assert cache.hits == 0 and "not_modified" not in server.requests
+    # The new response is stored
+    assert list(api.files(FOLDER_ID)) == changed_files
+    assert cache.hits == 1
+
+
+def test_evicted_responses_are_requested_again(server, api, cache, monkeypatch):
+    files = list(api.files(FOLDER_ID))
+    [(key, etag)] = cache._connection.execute("SELECT key, etag FROM response")
+    # Evicted after the conditional request was sent
+    cache._connection.execute("DELETE FROM response")
+    monkeypatch.setattr(cache, "conditional_headers", lambda _: {"If-None-Match": etag})
+    assert list(api.files(FOLDER_ID)) == files
+    assert server.requests["not_modified"] == 1 and cache.hits == 0
+    assert cache._connection.execute(
+        "SELECT COUNT(*) FROM response WHERE key = ?", (key,)
+    ).fetchone() == (1,)
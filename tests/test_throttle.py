@@ -0,0 +1,41 @@
+"Tests of the rate limiter and the retries of the requests"
+
+from __future__ import annotations
+
+import requests
+
+from canvas_stream.api.throttle import RateLimiter, RetryPolicy, should_retry
+
+
+def response(status_code: int, headers: dict[str, str] | None = None):
+    "A response received with `status_code` and `headers`"
+    result = requests.Response()
+    result.status_code = status_code
+    result.headers.update(headers or {})
+    return result
+
+
+def test_retry_after_of_a_throttled_response():
+    throttled = response(429, {"Retry-After": "30"})
+    assert should_retry(throttled)
+    assert RetryPolicy().delay(0, throttled) == 30
+
+
+def test_retry_after_is_bounded():
+    throttled = response(503, {"Retry-After": "3600"})
+    assert RetryPolicy(max_delay=60).delay(0, throttled) == 60
+
+
+def test_backoff_without_retry_after():
+    policy = RetryPolicy(base_delay=1, max_delay=60)
+    assert all(0 <= policy.delay(2, response(500)) <= 4 for _ in range(100))
+
+
+def test_limiter_follows_the_canvas_quota():
+    limiter = RateLimiter(refill_rate=0)
+    limiter.update({"X-Rate-Limit-Remaining": "300", "X-Request-Cost": "50"})
+    assert round(limiter.remaining) == 300
+    # A response of the file CDN returns the reserved cost
+    reserved = limiter.acquire()
+    limiter.update({}, reserved)
+    assert round(limiter.remaining) == 300